@@ -2,10 +2,52 @@ from pybitcointools import *
 import rlp
 import re
 from transactions import Transaction
-from trie import Trie
+from trie import Trie, default_registry
 import sys
 
-class Block():
+def account_storage_roots(value):
+    """
+    Returns the contract storage root referenced by an encoded account
+    record, for use as a trie.Pruner leaf_roots callback.
+    """
+    state = rlp.decode(value)
+    if isinstance(state,list) and len(state) == 3 and state[0] == 1 and state[2]:
+        return [ state[2] ]
+    return []
+
+class Account(object):
+    """
+    Decoded account record, as cached by Block.
+
+    Attributes:
+        type (int): 0 for a normal account, 1 for a contract.
+        balance (int): The account balance.
+        extra: The nonce of a normal account, or the storage root (str) of
+            a contract.
+    """
+    __slots__ = ['type','balance','extra']
+
+    def __init__(self,type=0,balance=0,extra=0):
+        self.type = type
+        self.balance = balance
+        self.extra = extra
+
+    @classmethod
+    def decode(cls,value):
+        # Returns None for an empty record
+        state = rlp.decode(value)
+        if not state: return None
+        return cls(state[0],state[1],state[2])
+
+    def to_list(self): return [ self.type, self.balance, self.extra ]
+
+    def encode(self): return rlp.encode(self.to_list())
+
+# Block fields that make up its encoding, besides the state root
+SERIALIZED_FIELDS = frozenset(['number','prevhash','coinbase','difficulty','timestamp',
+                               'nonce','extra','transactions','uncles'])
+
+class Block(object):
     """
     Represents a block in the Ethereum blockchain.
 
@@ -24,8 +66,57 @@ class Block():
         state (Trie): The state trie of the block.
         reward (int): The reward for mining the block.
         uncles (list): List of uncles included in the block.
+        registry (DBRegistry): Where the state database is opened.
+        index (Snapshot): Optional flat state index, passed as snapshot,
+            used for reads while it matches the state committed last.
+        body (LazyList): The block as received, of which only the header
+            is decoded up front; transactions and uncles are decoded from
+            it when first used.
+
+    State changes must go through touch, set_account and update_contract
+    so that they are seen by reads served from the index, and undone by
+    revert. Accounts changed through touch are only written to the state
+    trie by flush, which snapshot, commit and serialize call first.
+
+    The encoding and hash are cached until a field is assigned, the state
+    root moves or the encoding of the transactions changes, including a
+    transaction modified in place. The uncles list must be replaced rather
+    than modified in place.
     """
-    def __init__(self,data=None):
+    __slots__ = ['registry','index','contract_roots','accounts','storage','cleared',
+                 'checkpoints','undo','cache','dirty','body',
+                 'number','prevhash','uncles_root','coinbase','transactions_root',
+                 'difficulty','timestamp','nonce','extra','transactions','uncles',
+                 'state','base_root','reward','reads','writes',
+                 '__encoded','__encoded_root','__encoded_txs','__hash']
+
+    def __init__(self,data=None,registry=None,snapshot=None,lazy=False):
+
+        self.__encoded = None
+        self.__hash = None
+        self.registry = registry or default_registry
+        self.index = snapshot
+
+        # Storage roots written by update_contract since the last commit
+        self.contract_roots = set()
+        # Account and storage changes since the last commit, and addresses
+        # whose storage was wiped
+        self.accounts = {}
+        self.storage = {}
+        self.cleared = set()
+        # Open checkpoints, and the old contents of every tracking entry
+        # changed while one is open (see snapshot)
+        self.checkpoints = []
+        self.undo = []
+        # Decoded accounts by address (None when there is no record), and
+        # the addresses changed through touch but not yet flushed
+        self.cache = {}
+        self.dirty = set()
+        # When sets, the addresses whose accounts are read and written; None
+        # among the reads stands for the whole state (see serialize)
+        self.reads = None
+        self.writes = None
+        self.body = None
 
         if not data:
             return
@@ -33,7 +124,8 @@ class Block():
         if re.match('^[0-9a-fA-F]*$',data):
             data = data.decode('hex')
 
-        header,  transaction_list, self.uncles = rlp.decode(data)
+        self.body = rlp.decode_lazy(data)
+        header = self.body[0].to_list()
         [ self.number,
           self.prevhash,
           self.uncles_root,
@@ -44,19 +136,63 @@ class Block():
           self.timestamp,
           self.nonce,
           self.extra ] = header
-        self.transactions = [Transaction(x) for x in transaction_list]
-        self.state = Trie('statedb',state_root)
+        self.state = Trie(self.registry.get('statedb'),state_root)
+        self.base_root = state_root
         self.reward = 0
 
-        # Verifications
-        if self.state.root != '' and self.state.db.get(self.state.root) == '':
+        # A lazy block is only a header view until it is used or validated
+        if not lazy:
+            self.validate()
+
+    def __getattr__(self,name):
+        # Decodes the parts of the body on first use
+        if name in ('transactions','uncles') and self.body is not None:
+            if name == 'transactions':
+                return self.__decode_transactions()
+            self.uncles = self.body[2].to_list()
+            return self.uncles
+        raise AttributeError(name)
+
+    def __setattr__(self,name,value):
+        if name in SERIALIZED_FIELDS:
+            object.__setattr__(self,'_Block__encoded',None)
+            object.__setattr__(self,'_Block__hash',None)
+        object.__setattr__(self,name,value)
+
+    def __undecoded(self,name):
+        # Whether a part of the body has been neither decoded nor assigned
+        try: object.__getattribute__(self,name)
+        except AttributeError: return self.body is not None
+        return False
+
+    def __decode_transactions(self):
+        self.transactions = [Transaction(x) for x in self.body[1].to_list()]
+        return self.transactions
+
+    def validate(self,check_state=True):
+        """
+        Runs the checks deferred when the block was parsed lazily, and
+        decodes its transactions, recovering their senders.
+
+        Args:
+            check_state (bool): Whether to require the block's state root to
+                be in the database. A block received from a peer only has
+                its state once it has been processed.
+
+        Raises:
+            Exception: If a check fails.
+        """
+        if check_state and self.state.root != '' and self.state.db.get(self.state.root) == '':
             raise Exception("State Merkle root not found in database!")
-        if bin_sha256(rlp.encode(transaction_list)) != self.transactions_root:
-            raise Exception("Transaction list root hash does not match!")
-        if bin_sha256(rlp.encode(self.uncles)) != self.uncles_root:
-            raise Exception("Uncle root hash does not match!")
+        if self.body is not None:
+            if bin_sha256(self.body[1].raw()) != self.transactions_root:
+                raise Exception("Transaction list root hash does not match!")
+            if bin_sha256(self.body[2].raw()) != self.uncles_root:
+                raise Exception("Uncle root hash does not match!")
+            if self.__undecoded('transactions'):
+                self.__decode_transactions()
         # TODO: check POW
-            
+
     def pay_fee(self,address,fee,tominer=True):
         """
         Pays the specified fee from the given address. If tominer is True, the fee is paid to the miner.
@@ -70,53 +206,281 @@ class Block():
             bool: True if the fee was successfully paid, False otherwise.
         """
         # Subtract fee from sender
-        sender_state = rlp.decode(self.state.get(address))
-        if not sender_state or sender_state[1] < fee:
+        sender = self.account(address)
+        if not sender or sender.balance < fee:
             return False
-        sender_state[1] -= fee
-        self.state.update(address,sender_state)
+        self.touch(address).balance -= fee
         # Pay fee to miner
         if tominer:
-            miner_state = rlp.decode(self.state.get(self.coinbase)) or [0,0,0]
-            miner_state[1] += fee
-            self.state.update(self.coinbase,miner_state)
+            self.touch(self.coinbase).balance += fee
         return True
 
+    def __use_index(self):
+        return self.index is not None and self.index.root == self.base_root
+
+    def __set(self,container,key,value=None):
+        # Adds to a tracking set, or sets a tracking dict entry, logging the
+        # old contents while a checkpoint is open
+        if self.checkpoints:
+            self.undo.append((container,key,key in container,
+                              None if isinstance(container,set) else container.get(key)))
+        if isinstance(container,set): container.add(key)
+        else: container[key] = value
+
+    def __remove(self,container,key):
+        if self.checkpoints:
+            self.undo.append((container,key,True,container[key]))
+        del container[key]
+
+    def account(self,address):
+        """
+        Returns the decoded account at the given address, or None if there
+        is none. The result is cached and must not be modified; use touch
+        to change an account.
+        """
+        if self.reads is not None: self.reads.add(address)
+        if address not in self.cache:
+            self.cache[address] = Account.decode(self.get_account(address))
+        return self.cache[address]
+
+    def touch(self,address,type=0):
+        """
+        Returns the account at the given address for modification, creating
+        an empty one of the given type if there is none. The changes are
+        written to the state trie by the next flush.
+        """
+        acct = self.account(address)
+        if acct is None:
+            acct = self.cache[address] = Account(type,0,'' if type else 0)
+        if self.writes is not None: self.writes.add(address)
+        self.dirty.add(address)
+        return acct
+
+    def flush(self):
+        """
+        Writes the accounts changed through touch to the state trie in one
+        batch update.
+        """
+        if not self.dirty: return
+        items = [ (address,self.cache[address].encode()) for address in self.dirty ]
+        self.dirty = set()
+        self.state.update_many(items)
+        for address, value in items:
+            self.__set(self.accounts,address,value)
+
+    def snapshot(self):
+        """
+        Opens a checkpoint that the block's state can later be reverted to,
+        e.g. around a transaction that may fail.
+
+        Only the state root, the reward and an undo log of the block's
+        change tracking are kept. New trie nodes stay in the database's
+        write overlay, so nothing is written until the block is committed.
+
+        Returns:
+            int: The checkpoint id, for revert or commit.
+        """
+        self.flush()
+        self.state.db.buffer()
+        self.checkpoints.append((len(self.undo),self.state.snapshot(),self.reward))
+        return len(self.checkpoints) - 1
+
+    def revert(self,checkpoint):
+        """
+        Undoes every state change made since the given checkpoint, and
+        closes it together with any checkpoints opened after it.
+        """
+        if not 0 <= checkpoint < len(self.checkpoints):
+            raise Exception("unknown checkpoint")
+        size, state_checkpoint, self.reward = self.checkpoints[checkpoint]
+        while len(self.undo) > size:
+            container, key, present, old = self.undo.pop()
+            if isinstance(container,set):
+                if not present: container.discard(key)
+            elif present: container[key] = old
+            else: container.pop(key,None)
+        self.state.revert(state_checkpoint)
+        del self.checkpoints[checkpoint:]
+        # Cached accounts may hold changes made after the checkpoint
+        self.cache, self.dirty = {}, set()
+
+    def get_account(self,address):
+        """
+        Returns the encoded account record at the given address, or '' if
+        there is none.
+        """
+        if self.reads is not None: self.reads.add(address)
+        if address in self.dirty:
+            return self.cache[address].encode()
+        if address in self.accounts:
+            return self.accounts[address]
+        if self.__use_index():
+            return self.index.get_account(address)
+        return self.state.get(address)
+
+    def set_account(self,address,value):
+        if self.writes is not None: self.writes.add(address)
+        self.state.update(address,value)
+        self.__set(self.accounts,address,value)
+        self.cache.pop(address,None)
+        self.dirty.discard(address)
+
     def get_nonce(self,address):
-        state = rlp.decode(self.state.get(address))
-        if not state or state[0] == 0: return False
-        return state[2]
+        acct = self.account(address)
+        if not acct or acct.type == 0: return False
+        return acct.extra
 
     def get_balance(self,address):
-        state = rlp.decode(self.state.get(address))
-        return state[1] if state else 0
+        acct = self.account(address)
+        return acct.balance if acct else 0
 
     def set_balance(self,address,balance):
-        state = rlp.decode(self.state.get(address)) or [0,0,0]
-        state[1] = balance
-        self.state.update(address,rlp.encode(state))
+        self.touch(address).balance = balance
 
 
     # Making updates to the object obtained from this method will do nothing. You need
     # to call update_contract to finalize the changes.
     def get_contract(self,address):
-        state = rlp.decode(self.state.get(address))
-        if not state or state[0] == 0: return False
-        return Trie('statedb',state[2])
+        acct = self.account(address)
+        if not acct or acct.type == 0: return False
+        contract = Trie(self.state.db,acct.extra)
+        contract.journal = {}
+        return contract
+
+    def get_storage(self,address,key):
+        """
+        Returns the value stored under key in the contract at address, or
+        '' if there is none.
+        """
+        if self.reads is not None: self.reads.add(address)
+        if (address,key) in self.storage:
+            return self.storage[(address,key)]
+        if address in self.cleared:
+            return ''
+        if self.__use_index():
+            return self.index.get_storage(address,key)
+        contract = self.get_contract(address)
+        return contract.get(key) if contract else ''
+
+    def get_contract_state(self,address,key):
+        """
+        Returns the value stored under key in the contract at address as an
+        integer, 0 if there is none.
+        """
+        return decode(self.get_storage(address,key),256)
 
     def update_contract(self,address,contract):
-        state = rlp.decode(self.state.get(address)) or [1,0,'']
-        if state[0] == 0: return False
-        state[2] = contract.root
-        self.state.update(address,state)
+        acct = self.account(address)
+        if acct and acct.type == 0: return False
+        self.touch(address,1).extra = contract.root
+        self.__set(self.contract_roots,contract.root)
+        # An emptied contract keeps no slots, whatever it wrote before
+        if contract.root == '':
+            self.__set(self.cleared,address)
+            for k in [ k for k in self.storage if k[0] == address ]:
+                self.__remove(self.storage,k)
+        else:
+            for key, value in (contract.journal or {}).items():
+                self.__set(self.storage,(address,key),value)
+        contract.journal = {}
+
+    def changes(self,checkpoint):
+        """
+        Returns the net effect of everything done since the given open
+        checkpoint, for apply_changes on another copy of the block that
+        started from the same state. Touched accounts are flushed first.
+
+        Returns:
+            dict: Final account records ('accounts'), storage values, None
+            for removed ones ('storage'), newly cleared addresses
+            ('cleared'), new storage roots ('contract_roots') and the
+            increase in reward ('reward').
+        """
+        if not 0 <= checkpoint < len(self.checkpoints):
+            raise Exception("unknown checkpoint")
+        self.flush()
+        size, state_checkpoint, reward = self.checkpoints[checkpoint]
+        out = { 'accounts': {}, 'storage': {}, 'cleared': set(),
+                'contract_roots': set(), 'reward': self.reward - reward }
+        for container, key, present, old in self.undo[size:]:
+            if container is self.accounts:
+                out['accounts'][key] = self.accounts[key]
+            elif container is self.storage:
+                out['storage'][key] = self.storage.get(key)
+            elif container is self.cleared:
+                if key in self.cleared: out['cleared'].add(key)
+            elif key in self.contract_roots:
+                out['contract_roots'].add(key)
+        return out
+
+    def apply_changes(self,changes):
+        """
+        Applies changes taken from another copy of the block with changes(),
+        as if they had been made here. The trie nodes they refer to must
+        already be in the state database.
+        """
+        self.flush()
+        accounts = changes['accounts']
+        self.state.update_many(accounts.items())
+        for address, value in accounts.items():
+            self.__set(self.accounts,address,value)
+            self.cache.pop(address,None)
+        if self.writes is not None: self.writes.update(accounts)
+        for key, value in changes['storage'].items():
+            if value is not None: self.__set(self.storage,key,value)
+            elif key in self.storage: self.__remove(self.storage,key)
+        for address in changes['cleared']: self.__set(self.cleared,address)
+        for root in changes['contract_roots']: self.__set(self.contract_roots,root)
+        self.reward += changes['reward']
+
+    def commit(self,checkpoint=None):
+        """
+        With a checkpoint id, keeps the changes made since that checkpoint
+        and closes it together with any checkpoints opened after it.
+
+        Otherwise writes the block's buffered state nodes, and those of the
+        contracts updated since the last commit, to the database in one
+        batch, and moves the index forward if it matched the previous state.
+
+        Returns:
+            int: The number of nodes written.
+        """
+        if checkpoint is not None:
+            if not 0 <= checkpoint < len(self.checkpoints):
+                raise Exception("unknown checkpoint")
+            self.state.commit(self.checkpoints[checkpoint][1])
+            del self.checkpoints[checkpoint:]
+            if not self.checkpoints: self.undo = []
+            return 0
+        if self.checkpoints:
+            raise Exception("cannot commit a block with open checkpoints")
+        self.flush()
+        roots = [self.state.root] + list(self.contract_roots)
+        self.contract_roots = set()
+        written = self.state.db.commit(roots)
+        if self.__use_index():
+            self.index.apply(self.state.root,self.accounts,self.storage,self.cleared)
+        self.accounts, self.storage, self.cleared = {}, {}, set()
+        self.base_root = self.state.root
+        return written
 
     # Serialization method; should act as perfect inverse function of the constructor
     # assuming no verification failures
     def serialize(self):
-        txlist = [x.serialize() for x in self.transactions]
+        if self.reads is not None: self.reads.add(None)
+        self.flush()
+        # Parts of the body still undecoded are copied as received
+        if self.__undecoded('transactions'): txlist, txs = self.body[1], None
+        else:
+            txlist = [x.serialize() for x in self.transactions]
+            txs = tuple(txlist)
+        if self.__encoded is not None and self.__encoded_root == self.state.root \
+                and self.__encoded_txs == txs:
+            return self.__encoded
+        uncles = self.body[2] if self.__undecoded('uncles') else self.uncles
         header = [ self.number,
                    self.prevhash,
-                   bin_sha256(rlp.encode(self.uncles)),
+                   bin_sha256(rlp.encode(uncles)),
                    self.coinbase,
                    self.state.root,
                    bin_sha256(rlp.encode(txlist)),
@@ -124,7 +488,14 @@ class Block():
                    self.timestamp,
                    self.nonce,
                    self.extra ]
-        return rlp.encode([header, txlist, self.uncles ])
+        self.__encoded = rlp.encode([header, txlist, uncles ])
+        self.__encoded_root = self.state.root
+        self.__encoded_txs = txs
+        self.__hash = None
+        return self.__encoded
 
     def hash(self):
-        return bin_sha256(self.serialize())
+        encoded = self.serialize()
+        if self.__hash is None:
+            self.__hash = bin_sha256(encoded)
+        return self.__hash
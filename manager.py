@@ -1,6 +1,9 @@
 import rlp
 import leveldb
-from blocks import Block
+from blocks import Block, account_storage_roots
+from trie import Pruner
+from snapshot import Snapshot
+import storage
 from transactions import Transaction
 import processblock
 import hashlib
@@ -23,7 +26,13 @@ genesis_header = [
 
 genesis = [ genesis_header, [], [] ]
 
-mainblk = Block(rlp.encode(genesis))
+# Flat index of the head state, used for balance and storage reads
+snapshot = Snapshot(storage.LevelDBStore("snapshot"))
+
+mainblk = Block(rlp.encode(genesis),snapshot=snapshot)
+
+# Keeps the state of the last 256 blocks and collects the rest a batch at a time
+pruner = Pruner(mainblk.state.db,256,account_storage_roots)
 
 db = leveldb.LevelDB("objects")
 
@@ -58,7 +67,7 @@ def receive(obj):
     Returns:
         None or the requested data based on the message type.
     """
-    d = rlp.decode(obj)
+    d = rlp.decode_lazy(obj)
     # Is transaction
     if len(d) == 8:
         tx = Transaction(obj)
@@ -74,33 +83,66 @@ def receive(obj):
                 try: return mainblk.state.db.get(d[1][0])
                 except: return None
         elif d[0] == 'getbalance':
-            try: return mainblk.state.get_balance(d[1][0])
+            try: return mainblk.get_balance(d[1][0])
             except: return None
         elif d[0] == 'getcontractroot':
-            try: return mainblk.state.get_contract(d[1][0]).root
+            try: return mainblk.get_contract(d[1][0]).root
             except: return None
         elif d[0] == 'getcontractsize':
-            try: return mainblk.state.get_contract(d[1][0]).get_size()
+            try: return mainblk.get_contract(d[1][0]).get_size()
             except: return None
         elif d[0] == 'getcontractstate':
-            try: return mainblk.state.get_contract(d[1][0]).get(d[1][1])
+            try: return mainblk.get_storage(d[1][0],d[1][1])
+            except: return None
+        elif d[0] == 'getproof':
+            try: return mainblk.state.get_proof(d[1][0])
+            except: return None
+        elif d[0] == 'getcontractproof':
+            try: return [ mainblk.state.get_proof(d[1][0]),
+                          mainblk.get_contract(d[1][0]).get_proof(d[1][1]) ]
             except: return None
     # Is block
     elif len(d) == 3:
-        blk = Block(obj)
-        p = block.prevhash
+        # Route on the header alone; the body is only decoded once the
+        # parent and uncles are known
+        blk = Block(obj,lazy=True)
+        p = blk.prevhash
         try:
-            parent = Block(db.Get(p))
+            parent = Block(db.Get(p),snapshot=snapshot,lazy=True)
         except:
             return
-        uncles = block.uncles
+        uncles = blk.uncles
         for s in uncles:
             try:
                 sib = db.Get(s)
             except:
                 return
-        processblock.eval(parent,blk.transactions,blk.timestamp,blk.coinbase)
-        if parent.state.root != blk.state.root: return
-        if parent.difficulty != blk.difficulty: return
-        if parent.number != blk.number: return
+        try: blk.validate(check_state=False)
+        except: return
+        # Nothing is written or indexed until the result has been checked
+        processblock.eval(parent,list(blk.transactions),blk.timestamp,blk.coinbase,commit=False)
+        if parent.state.root != blk.state.root or parent.difficulty != blk.difficulty \
+                or parent.number != blk.number:
+            # Points the state back at its stored root, so that the commit
+            # drops the block's buffered nodes but keeps other tries' ones
+            parent.state.root = parent.base_root
+            parent.state.db.commit([])
+            return
+        parent.commit()
         db.Put(blk.hash(),blk.serialize())
+        pruner.add_root(blk.state.root)
+        pruner.step()
+
+def receive_stream(stream):
+    """
+    Processes every object read from a stream of concatenated RLP items,
+    such as a peer connection or a chain export.
+
+    Args:
+        stream (file or iterable): A file object or an iterable of byte chunks.
+
+    Yields:
+        The result of receive for each object, in order.
+    """
+    for obj in rlp.iter_decode(stream,raw=True):
+        yield receive(obj)
@@ -0,0 +1,172 @@
+HEX = '0123456789abcdef'
+
+# High and low nibble of every byte value
+_HI = [ b >> 4 for b in range(256) ]
+_LO = [ b & 15 for b in range(256) ]
+# Hex-prefix flag byte by (2 * terminator + odd length)
+_FLAGS = [ chr(x) for x in range(4) ]
+
+class NibblePath(object):
+    """
+    Trie key path stored as packed bytes with a nibble offset and length,
+    optionally followed by the terminator (nibble 16).
+
+    Behaves like the list of nibbles it stands for: indexing returns a
+    nibble (or 16 for the terminator) and slicing returns a new path over
+    the same bytes in O(1).
+
+    Attributes:
+        data (str): The packed bytes, two nibbles per byte.
+        start (int): Offset of the first nibble in data.
+        end (int): Offset just past the last nibble in data.
+        term (bool): Whether the path ends with the terminator.
+    """
+    __slots__ = ['data','start','end','term']
+
+    def __init__(self,data='',start=0,end=None,term=False):
+        self.data = data
+        self.start = start
+        self.end = 2 * len(data) if end is None else end
+        self.term = term
+
+    @classmethod
+    def from_key(cls,key):
+        # Full path of a trie key, with its terminator
+        return cls(key,0,2*len(key),True)
+
+    @classmethod
+    def from_encoded(cls,key):
+        # Decodes a hex-prefix encoded node key without copying its nibbles
+        flag = ord(key[0])
+        return cls(key[1:],flag & 1,2*(len(key)-1),flag >= 2)
+
+    @classmethod
+    def from_hex(cls,h,term=False):
+        if len(h) % 2: return cls((h+'0').decode('hex'),0,len(h),term)
+        return cls(h.decode('hex'),0,len(h),term)
+
+    @classmethod
+    def from_nibbles(cls,nibbles):
+        term = bool(nibbles) and nibbles[-1] == 16
+        return cls.from_hex(''.join([ HEX[x] for x in nibbles[:len(nibbles)-term] ]),term)
+
+    def __nibble(self,i):
+        b = ord(self.data[i >> 1])
+        return _LO[b] if i & 1 else _HI[b]
+
+    def __len__(self): return self.end - self.start + self.term
+
+    def __getitem__(self,i):
+        n = self.end - self.start
+        if isinstance(i,slice):
+            a, b = i.start, i.stop
+            if i.step is None and (a is None or a >= 0) and (b is None or b >= 0):
+                total = n + self.term
+                if a is None: a = 0
+                elif a > total: a = total
+                if b is None or b > total: b = total
+            else:
+                a, b, step = i.indices(n + self.term)
+            if b < a: b = a
+            return NibblePath(self.data,self.start+min(a,n),self.start+min(b,n),
+                              self.term and a <= n < b)
+        if i < 0: i += n + self.term
+        if i < 0 or i >= n + self.term:
+            raise IndexError("nibble index out of range")
+        if i == n: return 16
+        return self.__nibble(self.start + i)
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def hex(self):
+        # The nibbles, without the terminator, as a hex string
+        s = self.start
+        h = self.data[s >> 1:(self.end + 1) >> 1].encode('hex')
+        return h[s & 1:(s & 1) + self.end - s]
+
+    def encode(self):
+        """
+        Returns the hex-prefix encoding used for keys in trie nodes: a flag
+        byte (2 * terminator + odd length), then the nibbles packed into
+        bytes, with a leading zero nibble if there is an odd number.
+        """
+        s, e = self.start, self.end
+        odd = (e - s) & 1
+        flag = _FLAGS[2 * self.term + odd]
+        if not odd and not s & 1:
+            return flag + self.data[s >> 1:e >> 1]
+        if odd and s & 1:
+            return flag + chr(_LO[ord(self.data[s >> 1])]) + self.data[(s >> 1) + 1:e >> 1]
+        h = self.hex()
+        if odd: h = '0' + h
+        return flag + h.decode('hex')
+
+    def common_prefix(self,other):
+        """
+        Returns the length of the longest common prefix of two paths,
+        counting the terminator if both paths are equal and terminated.
+        """
+        n1, n2 = self.end - self.start, other.end - other.start
+        n = min(n1,n2)
+        if not (self.start ^ other.start) & 1:
+            i = self.__common_bytes(other,n)
+        else:
+            h1, h2 = self.hex()[:n], other.hex()[:n]
+            if h1 == h2:
+                i = n
+            else:
+                # Binary search for the first mismatch using string compares
+                lo, hi = 0, n - 1
+                while lo < hi:
+                    mid = (lo + hi + 1) >> 1
+                    if h1[:mid] == h2[:mid]: lo = mid
+                    else: hi = mid - 1
+                i = lo
+        if i == n1 == n2 and self.term and other.term: i += 1
+        return i
+
+    def __common_bytes(self,other,n):
+        # Common prefix, up to n nibbles, of a path whose nibbles sit at the
+        # same place in their bytes as this one's, compared on the packed bytes
+        d1, d2, s1, s2 = self.data, other.data, self.start, other.start
+        i = 0
+        if s1 & 1:
+            if n == 0 or _LO[ord(d1[s1 >> 1])] != _LO[ord(d2[s2 >> 1])]: return 0
+            i = 1
+        a1, a2, m = (s1 + i) >> 1, (s2 + i) >> 1, (n - i) >> 1
+        b1, b2 = d1[a1:a1+m], d2[a2:a2+m]
+        if b1 != b2:
+            j = 0
+            while b1[j] == b2[j]: j += 1
+            if _HI[ord(b1[j])] == _HI[ord(b2[j])]: return i + 2 * j + 1
+            return i + 2 * j
+        i += 2 * m
+        if i < n and _HI[ord(d1[(s1 + i) >> 1])] == _HI[ord(d2[(s2 + i) >> 1])]: i += 1
+        return i
+
+    def startswith(self,other):
+        return self.common_prefix(other) == len(other)
+
+    def __eq__(self,other):
+        if not isinstance(other,NibblePath): return NotImplemented
+        s1, s2, n = self.start, other.start, self.end - self.start
+        if self.term != other.term or n != other.end - s2: return False
+        if not (s1 | s2 | n) & 1:
+            return self.data[s1 >> 1:(s1 + n) >> 1] == other.data[s2 >> 1:(s2 + n) >> 1]
+        return self.common_prefix(other) == len(self)
+
+    def __ne__(self,other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __add__(self,other):
+        if self.term:
+            raise Exception("cannot extend a terminated path")
+        return NibblePath.from_hex(self.hex() + other.hex(),other.term)
+
+    def __repr__(self):
+        return 'NibblePath(%r%s)' % (self.hex(),', term' if self.term else '')
+
+# The path holding only the terminator, keyed by a branch's value slot
+TERMINATOR = NibblePath('',0,0,True)
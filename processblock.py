@@ -1,8 +1,11 @@
+from pybitcointools import *
 from transactions import Transaction
 from blocks import Block
 import time
-import sys
 import rlp
+import hashlib
+import multiprocessing
+from collections import OrderedDict
 
 scriptcode_map = {
     0x00: 'STOP',   
@@ -63,69 +66,152 @@ params = {
     'period_4_reward': 2**80 * 128
 }
 
-def process_transactions(block,transactions):
+def process_transactions(block,transactions,tracer=None):
     """
     Processes a list of transactions and updates the block state accordingly.
 
     Args:
         block (Block): The block to which the transactions belong.
         transactions (list): A list of Transaction objects to be processed.
+        tracer (tracing.Tracer): Optional receiver of execution events.
 
     Returns:
         None
     """
     while len(transactions) > 0:
         tx = transactions.pop(0)
-        enc = (tx.value, tx.fee, tx.sender.encode('hex'), tx.to.encode('hex'))
-        sys.stderr.write("Attempting to send %d plus fee %d from %s to %s\n" % enc)
+        if tracer is not None: tracer.on_tx_start(block,tx)
         # Grab data about sender, recipient and miner
-        sdata = rlp.decode(block.state.get(tx.sender)) or [0,0,0]
-        tdata = rlp.decode(block.state.get(tx.to)) or [0,0,0]
+        sender = block.account(tx.sender)
         # Calculate fee
         if tx.to == '\x00'*20:
             fee = params['newcontractfee'] + len(tx.data) * params['memoryfee']
         else:
             fee = params['txfee']
-        # Insufficient fee, do nothing
+        # Insufficient fee, too much data, insufficient funds or bad nonce:
+        # do nothing
         if fee > tx.fee:
-            sys.stderr.write("Insufficient fee\n")
-            continue
-        # Too much data, do nothing
-        if len(tx.data) > 256:
-            sys.stderr.write("Too many data items\n")
-            continue
-        if not sdata or sdata[1] < tx.value + tx.fee:
-            sys.stderr.write("Insufficient funds to send fee\n")
-            continue
-        elif tx.nonce != sdata[2] and sdata[0] == 0:
-            sys.stderr.write("Bad nonce\n")
-            continue
-        # Try to send the tx
-        if sdata[0] == 0: sdata[2] += 1
-        sdata[1] -= (tx.value + tx.fee)
-        block.reward += tx.fee
-        if tx.to != '':
-            tdata[1] += tx.value
+            status = 'insufficient fee'
+        elif len(tx.data) > 256:
+            status = 'too much data'
+        elif not sender or sender.balance < tx.value + tx.fee:
+            status = 'insufficient funds'
+        elif tx.nonce != sender.extra and sender.type == 0:
+            status = 'bad nonce'
         else:
-            addr = tx.hash()[-20:]
-            adata = rlp.decode(block.state.get(addr))
-            if adata[2] != '':
-                sys.stderr.write("Contract already exists\n")
+            status = None
+        if status is not None:
+            if tracer is not None: tracer.on_tx_end(block,tx,status)
+            continue
+        # Try to send the tx, undoing its changes if it fails part way
+        checkpoint = block.snapshot()
+        try:
+            sender = block.touch(tx.sender)
+            recipient = block.touch(tx.to)
+            if sender.type == 0: sender.extra += 1
+            sender.balance -= (tx.value + tx.fee)
+            block.reward += tx.fee
+            if tx.to != '':
+                recipient.balance += tx.value
+            else:
+                addr = tx.hash()[-20:]
+                adata = block.account(addr)
+                if adata and adata.extra != '':
+                    block.revert(checkpoint)
+                    if tracer is not None: tracer.on_tx_end(block,tx,'contract exists')
+                    continue
+                block.set_account(addr,rlp.encode([1,tx.value,'']))
+                contract = block.get_contract(addr)
+                contract.update_many([ (encode(i,256,32),tx.data[i]) for i in range(len(tx.data)) ])
+                block.update_contract(addr,contract)
+            # Evaluate contract if applicable
+            if recipient.type == 1:
+                eval_contract(block,transactions,tx,tracer)
+        except:
+            block.revert(checkpoint)
+            if tracer is not None: tracer.on_tx_end(block,tx,'error')
+            raise
+        block.commit(checkpoint)
+        if tracer is not None: tracer.on_tx_end(block,tx,'ok')
+
+# Block and transactions that process_transactions_parallel's workers
+# inherit when they are forked
+_speculation = None
+
+def _run_speculative(i):
+    # Runs one transaction, with any it creates, on the worker's copy of the
+    # block, and returns what it read and wrote, its net changes and the
+    # trie nodes it made, or None if it failed. The copy is then put back
+    # for the worker's next transaction.
+    block, transactions = _speculation
+    db = block.state.db
+    checkpoint = block.snapshot()
+    block.reads, block.writes, db.live = set(), set(), set()
+    try:
+        process_transactions(block,[transactions[i]])
+        changes = block.changes(checkpoint)
+        nodes = [ (h,db.get(h)) for h in db.live ]
+        return block.reads, block.writes, changes, nodes
+    except Exception:
+        return None
+    finally:
+        block.reads = block.writes = db.live = None
+        block.revert(checkpoint)
+
+def process_transactions_parallel(block,transactions,processes=None):
+    """
+    Processes a list of transactions with the same result as
+    process_transactions, running them optimistically in worker processes.
+
+    Every transaction is first run against the state the block starts
+    from, recording the accounts it reads and writes. The results are then
+    applied in order; a transaction that read or wrote an account written
+    by an earlier one, or that failed, is run again on the block itself.
+    Transactions created by a contract run belong to the one that created
+    them, as they are run straight after it.
+
+    Workers are forked from this process and read the block's state
+    database from there, so it must be usable after a fork.
+
+    Args:
+        block (Block): The block to which the transactions belong.
+        transactions (list): A list of Transaction objects to be processed.
+        processes (int): The number of workers; defaults to the number of CPUs.
+
+    Returns:
+        None
+    """
+    global _speculation
+    if processes == 1 or len(transactions) < 2:
+        return process_transactions(block,transactions)
+    block.flush()
+    block.state.db.buffer()
+    _speculation = (block,list(transactions))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_run_speculative,range(len(transactions)))
+    finally:
+        pool.terminate()
+        _speculation = None
+    written = set()
+    for tx, result in zip(list(transactions),results):
+        del transactions[0]
+        if result is not None:
+            reads, writes, changes, nodes = result
+            # None among the reads means the whole state was read
+            if not (reads | writes) & written and (None not in reads or not written):
+                block.state.db.put_nodes(nodes)
+                block.apply_changes(changes)
+                written |= writes
                 continue
-            block.state.update(addr,rlp.encode([1,tx.value,'']))
-            contract = block.get_contract(addr)
-            for i in range(len(tx.data)):
-                contract.update(encode(i,256,32),tx.data[i])
-            block.update_contract(addr)
-        print sdata, tdata
-        block.state.update(tx.sender,rlp.encode(sdata))
-        block.state.update(tx.to,rlp.encode(tdata))
-        # Evaluate contract if applicable
-        if tdata[0] == 1:
-            eval_contract(block,transactions,tx)
-        sys.stderr.write("tx processed\n")
-
-def eval(block,transactions,timestamp,coinbase):
+        block.reads, block.writes = set(), set()
+        try:
+            process_transactions(block,[tx])
+        finally:
+            written |= block.writes
+            block.reads = block.writes = None
+
+def eval(block,transactions,timestamp,coinbase,tracer=None,processes=1,commit=True):
     """
     Evaluates the block by processing transactions, paying miner fees, and updating the block state.
 
@@ -134,15 +220,28 @@ def eval(block,transactions,timestamp,coinbase):
         transactions (list): A list of Transaction objects to be processed.
         timestamp (int): The timestamp of the block.
         coinbase (str): The address of the miner.
+        tracer (tracing.Tracer): Optional receiver of execution events.
+        processes (int): Workers to run transactions on, None for one per
+            CPU (see process_transactions_parallel). Tracing needs 1.
+        commit (bool): Whether to commit the new state. Pass False when the
+            result must be checked first, then call block.commit() only
+            if it is accepted.
 
     Returns:
         Block: The updated block.
     """
+    if processes != 1 and tracer is not None:
+        raise Exception("tracing is not supported with parallel execution")
     h = block.hash()
+    # Keep intermediate trie nodes in memory until the block is final
+    block.state.db.buffer()
     # Process all transactions
-    process_transactions(block,transactions)
+    if processes == 1:
+        process_transactions(block,transactions,tracer)
+    else:
+        process_transactions_parallel(block,transactions,processes)
     # Pay miner fee
-    miner_state = rlp.decode(block.state.get(block.coinbase)) or [0,0,0]
+    miner = block.touch(block.coinbase)
     block.number += 1
     reward = 0
     if block.number < params['period_1_duration']:
@@ -153,14 +252,10 @@ def eval(block,transactions,timestamp,coinbase):
         reward = params['period_3_reward']
     else:
         reward = params['period_4_reward']
-    print reward
-    miner_state[1] += reward + block.reward
+    miner.balance += reward + block.reward
     for uncle in block.uncles:
-        sib_miner_state = rlp_decode(block.state.get(uncle[3]))
-        sib_miner_state[1] = encode(decode(sib_miner_state[1],256)+reward*7/8,256)
-        block.state.update(uncle[3],sib_miner_state)
-        miner_state[1] += reward/8
-    block.state.update(block.coinbase,rlp.encode(miner_state))
+        block.touch(uncle[3]).balance += reward*7/8
+        miner.balance += reward/8
     # Check timestamp
     if timestamp < block.timestamp or timestamp > int(time.time()) + 3600:
         raise Exception("timestamp not in valid range!")
@@ -173,192 +268,405 @@ def eval(block,transactions,timestamp,coinbase):
     block.coinbase = coinbase
     block.transactions = []
     block.uncles = []
+    if commit: block.commit()
+    if tracer is not None: tracer.on_block_end(block)
     return block
 
-def eval_contract(block,transaction_list,tx):
-    sys.stderr.write("evaluating contract\n")
+class StorageBuffer(object):
+    """
+    Contract storage as seen by one run. Values read are cached, and
+    writes are held until flush applies their net effect to the contract
+    trie in one batch update.
+
+    Attributes:
+        contract (Trie): The contract's storage trie.
+        values (dict): Values read or written so far, by key.
+        written (set): Keys written since the last flush.
+    """
+    __slots__ = ['contract','values','written']
+
+    def __init__(self,contract):
+        self.contract = contract
+        self.values = {}
+        self.written = set()
+
+    def get(self,key):
+        if key not in self.values:
+            self.values[key] = self.contract.get(key)
+        return self.values[key]
+
+    def put(self,key,value):
+        self.values[key] = value
+        self.written.add(key)
+
+    def flush(self):
+        if not self.written: return
+        self.contract.update_many([ (key,self.values[key]) for key in self.written ])
+        self.written = set()
+
+class Frame(object):
+    """
+    State of one contract run, passed to the opcode handlers.
+
+    Attributes:
+        block (Block): The block being processed.
+        transaction_list (list): Pending transactions; MKTX queues new ones
+            at the front.
+        tx (Transaction): The transaction that triggered the run.
+        address (str): The contract's address.
+        contract (Trie): The contract's storage.
+        storage (StorageBuffer): Buffered access to the contract's storage.
+        reg (list): The 256 registers.
+        index (int): Code index of the current instruction.
+        next (int): Code index of the next instruction; jumps set it.
+        stored (set): Code indices written by STORE during the run, whose
+            cached instructions are stale.
+    """
+    __slots__ = ['block','transaction_list','tx','address','contract','storage','reg',
+                 'index','next','stored']
+
+    def __init__(self,block,transaction_list,tx,contract):
+        self.block = block
+        self.transaction_list = transaction_list
+        self.tx = tx
+        self.address = tx.to
+        self.contract = contract
+        self.storage = StorageBuffer(contract)
+        self.reg = [0] * 256
+        self.reg[0] = decode(tx.sender,256)
+        self.reg[1] = decode(tx.to,256)
+        self.reg[2] = tx.value
+        self.reg[3] = tx.fee
+        self.index = 0
+        self.next = 1
+        self.stored = set()
+
+def op_add(f,code): f.reg[code[3]] = (f.reg[code[1]] + f.reg[code[2]]) % 2**256
+
+def op_mul(f,code): f.reg[code[3]] = (f.reg[code[1]] * f.reg[code[2]]) % 2**256
+
+def op_sub(f,code): f.reg[code[3]] = (f.reg[code[1]] + 2**256 - f.reg[code[2]]) % 2**256
+
+# Division and remainder by zero give 0, so that a contract cannot make
+# the block that calls it fail to process
+def op_div(f,code):
+    f.reg[code[3]] = int(f.reg[code[1]] / f.reg[code[2]]) if f.reg[code[2]] else 0
+
+def op_sdiv(f,code):
+    reg = f.reg
+    if not reg[code[2]]:
+        reg[code[3]] = 0
+        return
+    sign = 1
+    sign *= (1 if reg[code[1]] < 2**255 else -1)
+    sign *= (1 if reg[code[2]] < 2**255 else -1)
+    x = reg[code[1]] if reg[code[1]] < 2**255 else 2**256 - reg[code[1]]
+    y = reg[code[2]] if reg[code[2]] < 2**255 else 2**256 - reg[code[2]]
+    z = int(x/y)
+    reg[code[3]] = z if sign == 1 else (2**256 - z) % 2**256
+
+def op_mod(f,code):
+    f.reg[code[3]] = f.reg[code[1]] % f.reg[code[2]] if f.reg[code[2]] else 0
+
+def op_smod(f,code):
+    reg = f.reg
+    if not reg[code[2]]:
+        reg[code[3]] = 0
+        return
+    sign = 1
+    sign *= (1 if reg[code[1]] < 2**255 else -1)
+    sign *= (1 if reg[code[2]] < 2**255 else -1)
+    x = reg[code[1]] if reg[code[1]] < 2**255 else 2**256 - reg[code[1]]
+    y = reg[code[2]] if reg[code[2]] < 2**255 else 2**256 - reg[code[2]]
+    z = x%y
+    reg[code[3]] = z if sign == 1 else (2**256 - z) % 2**256
+
+def op_exp(f,code): f.reg[code[3]] = pow(f.reg[code[1]],f.reg[code[2]],2**256)
+
+def op_neg(f,code): f.reg[code[2]] = 2**256 - f.reg[code[1]]
+
+def op_lt(f,code): f.reg[code[3]] = 1 if f.reg[code[1]] < f.reg[code[2]] else 0
+
+def op_le(f,code): f.reg[code[3]] = 1 if f.reg[code[1]] <= f.reg[code[2]] else 0
+
+def op_gt(f,code): f.reg[code[3]] = 1 if f.reg[code[1]] > f.reg[code[2]] else 0
+
+def op_ge(f,code): f.reg[code[3]] = 1 if f.reg[code[1]] >= f.reg[code[2]] else 0
+
+def op_eq(f,code): f.reg[code[3]] = 1 if f.reg[code[1]] == f.reg[code[2]] else 0
+
+def op_not(f,code): f.reg[code[2]] = 1 if f.reg[code[1]] == 0 else 0
+
+def op_sha256(f,code):
+    inp = encode(f.reg[code[1]],256,32)
+    f.reg[code[2]] = decode(hashlib.sha256(inp).digest(),256)
+
+def op_ripemd160(f,code):
+    inp = encode(f.reg[code[1]],256,32)
+    f.reg[code[2]] = decode(hashlib.new('ripemd160',inp).digest(),256)
+
+def op_ecmul(f,code):
+    reg = f.reg
+    pt = (reg[code[1]],reg[code[2]])
+    # Point at infinity
+    if pt[0] == 0 and pt[1] == 0:
+        reg[code[4]], reg[code[5]] = 0,0
+    # Point not on curve, coerce to infinity
+    elif (pt[0] ** 3 + 7 - pt[1] ** 2) % N != 0:
+        reg[code[4]], reg[code[5]] = 0,0
+    # Legitimate point
+    else:
+        pt2 = base10_multiply(pt,reg[code[3]])
+        reg[code[4]], reg[code[5]] = pt2[0], pt2[1]
+
+def op_ecadd(f,code):
+    reg = f.reg
+    pt1 = (reg[code[1]],reg[code[2]])
+    pt2 = (reg[code[3]],reg[code[4]])
+    # Invalid point 1
+    if (pt1[0] ** 3 + 7 - pt1[1] ** 2) % N != 0:
+        reg[code[5]], reg[code[6]] = 0,0
+    # Invalid point 2
+    elif (pt2[0] ** 3 + 7 - pt2[1] ** 2) % N != 0:
+        reg[code[5]], reg[code[6]] = 0,0
+    # Legitimate points
+    else:
+        pt3 = base10_add(pt1,pt2)
+        reg[code[5]], reg[code[6]] = pt3[0], pt3[1]
+
+def op_ecsign(f,code):
+    reg = f.reg
+    reg[code[3]], reg[code[4]], reg[code[5]] = ecdsa_raw_sign(reg[code[1]],reg[code[2]])
+
+def op_ecrecover(f,code):
+    reg = f.reg
+    pt = ecdsa_raw_recover((reg[code[2]],reg[code[3]],reg[code[4]]),reg[code[1]])
+    reg[code[5]] = pt[0]
+    reg[code[6]] = pt[1]
+
+def op_copy(f,code): f.reg[code[2]] = f.reg[code[1]]
+
+def op_store(f,code):
+    f.stored.add(f.reg[code[2]])
+    f.storage.put(encode(f.reg[code[2]],256,32),encode(f.reg[code[1]],256))
+
+def op_load(f,code): f.reg[code[2]] = decode(f.storage.get(encode(f.reg[code[1]],256,32)),256)
+
+def op_set(f,code):
+    f.reg[code[1]] = (code[2] + 256 * code[3] + 65536 * code[4] + 16777216 * code[5]) * 2**code[6] % 2**256
+
+def op_jmp(f,code): f.next = f.reg[code[1]]
+
+def op_jmpi(f,code):
+    if f.reg[code[1]]: f.next = f.reg[code[2]]
+
+def op_ind(f,code): f.reg[code[1]] = f.index
+
+def op_extro(f,code):
+    if f.reg[code[1]] >= 2**160:
+        f.reg[code[3]] = 0
+    else:
+        address = encode(f.reg[code[1]],256,20)
+        field = encode(f.reg[code[2]],256,32)
+        f.reg[code[3]] = decode(f.block.get_storage(address,field),256)
+
+def op_balance(f,code):
+    if f.reg[code[1]] >= 2**160:
+        f.reg[code[2]] = 0
+    else:
+        address = encode(f.reg[code[1]],256,20)
+        f.reg[code[2]] = f.block.get_balance(address)
+
+def op_mktx(f,code):
+    reg = f.reg
+    to = encode(reg[code[1]],256,20)
+    value = reg[code[2]]
+    fee = reg[code[3]]
+    if (value + fee) > f.block.get_balance(f.address):
+        pass
+    else:
+        datan = reg[code[4]]
+        data = []
+        for i in range(datan):
+            ind = encode((reg[code[5]] + i) % 2**256,256,32)
+            data.append(f.storage.get(ind))
+        tx = Transaction(0,to,value,fee,data)
+        tx.sender = f.address
+        f.transaction_list.insert(0,tx)
+
+# Data items past the end of the transaction read as 0
+def op_data(f,code):
+    i = f.reg[code[1]]
+    f.reg[code[2]] = decode(f.tx.data[i],256) if i < len(f.tx.data) else 0
+
+def op_datan(f,code): f.reg[code[1]] = len(f.tx.data)
+
+def op_myaddress(f,code): f.reg[code[1]] = decode(f.address,256)
+
+def op_blkhash(f,code): f.reg[code[1]] = decode(f.block.hash(),256)
+
+# RAWTX is reserved and, as before, costs a step without doing anything
+def op_rawtx(f,code): pass
+
+def op_suicide(f,code):
+    f.storage.flush()
+    sz = f.contract.get_size()
+    negfee = -sz * params["memoryfee"]
+    toaddress = encode(f.reg[code[1]],256,20)
+    f.block.pay_fee(toaddress,negfee,False)
+    f.contract.root = ''
+    return True
+
+handler_map = {
+    'ADD': op_add, 'SUB': op_sub, 'MUL': op_mul, 'DIV': op_div, 'SDIV': op_sdiv,
+    'MOD': op_mod, 'SMOD': op_smod, 'EXP': op_exp, 'NEG': op_neg,
+    'LT': op_lt, 'LE': op_le, 'GT': op_gt, 'GE': op_ge, 'EQ': op_eq, 'NOT': op_not,
+    'SHA256': op_sha256, 'RIPEMD-160': op_ripemd160, 'ECMUL': op_ecmul,
+    'ECADD': op_ecadd, 'ECSIGN': op_ecsign, 'ECRECOVER': op_ecrecover,
+    'COPY': op_copy, 'STORE': op_store, 'LOAD': op_load, 'SET': op_set,
+    'JMP': op_jmp, 'JMPI': op_jmpi, 'IND': op_ind,
+    'EXTRO': op_extro, 'BALANCE': op_balance, 'MKTX': op_mktx,
+    'DATA': op_data, 'DATAN': op_datan, 'MYADDRESS': op_myaddress,
+    'RAWTX': op_rawtx, 'BLKHASH': op_blkhash, 'SUICIDE': op_suicide
+}
+
+# Opcode handlers and per-opcode miner fees, indexed by opcode. STOP and
+# unknown opcodes have no handler, which ends execution.
+handlers = [ None ] * 256
+opcode_fees = [ 0 ] * 256
+for op, name in scriptcode_map.items():
+    handlers[op] = handler_map.get(name)
+    if name in ['STORE','LOAD']:
+        opcode_fees[op] = params["datafee"]
+    elif name in ['EXTRO','BALANCE']:
+        opcode_fees[op] = params["extrofee"]
+    elif name in ['SHA256','RIPEMD-160','ECMUL','ECADD','ECSIGN','ECRECOVER']:
+        opcode_fees[op] = params["cryptofee"]
+# STORE also pays or refunds memory fees
+STORE = 0x41
+# Opcodes that see the contract's balance or the state root, before which
+# fees charged so far must be settled
+settle_before = [ False ] * 256
+for op, name in scriptcode_map.items():
+    settle_before[op] = name in ['BALANCE','MKTX','BLKHASH','SUICIDE']
+
+class Meter(object):
+    """
+    Fee accounting for one contract run. Fees are charged against a copy
+    of the contract's balance and the miner's share is counted locally,
+    so that the block is only updated when the run settles.
+
+    Attributes:
+        block (Block): The block being processed.
+        address (str): The contract's address.
+        balance (int): The contract's balance, net of the fees charged.
+        reward (int): Miner fees charged since the last settlement.
+        settled (int): The balance as of the last settlement.
+    """
+    __slots__ = ['block','address','balance','reward','settled']
+
+    def __init__(self,block,address):
+        self.block = block
+        self.address = address
+        self.balance = self.settled = block.get_balance(address)
+        self.reward = 0
+
+    def charge(self,minerfee,nullfee):
+        """
+        Charges the fees for one step.
+
+        Returns:
+            bool: False, charging nothing, if the balance does not cover them.
+        """
+        if self.balance < minerfee + nullfee:
+            return False
+        self.balance -= nullfee + minerfee
+        self.reward += minerfee
+        return True
+
+    def settle(self):
+        # Writes the balance and miner fees to the block
+        if self.balance != self.settled:
+            self.block.set_balance(self.address,self.balance)
+        self.block.reward += self.reward
+        self.reward = 0
+
+    def reload(self):
+        # Picks up balance changes made directly on the block
+        self.balance = self.settled = self.block.get_balance(self.address)
+
+def decode_instruction(word):
+    """
+    Splits a code word into its opcode and argument bytes, lowest byte
+    first, or returns None if the word stops execution.
+    """
+    val = decode(word,256)
+    if val >= 256**6 or handlers[val & 255] is None:
+        return None
+    return [ (val >> (8 * i)) & 255 for i in range(7) ]
+
+# Number of contract programs kept in code_cache
+CODE_CACHE_SIZE = 1024
+# Decoded instructions by contract root, each a dict by code index, most
+# recently used last
+code_cache = OrderedDict()
+
+def get_program(root):
+    program = code_cache.pop(root,None)
+    if program is None: program = {}
+    code_cache[root] = program
+    while len(code_cache) > CODE_CACHE_SIZE: code_cache.popitem(last=False)
+    return program
+
+def eval_contract(block,transaction_list,tx,tracer=None):
     address = tx.to
-    # Initialize registers
-    reg = [0] * 256
-    reg[0] = decode(tx.sender,256)
-    reg[1] = decode(tx.to,256)
-    reg[2] = tx.value
-    reg[3] = tx.fee
-    index = 0
-    stepcounter = 0
     contract = block.get_contract(address)
     if not contract:
         return
+    f = Frame(block,transaction_list,tx,contract)
+    meter = Meter(block,address)
+    program = get_program(contract.root)
+    stepcounter = 0
     while 1:
-        # Convert the data item into a code piece
-        val_at_index = decode(contract.get(encode(index,256,32)),256)
-        code = [ int(val_at_index / (256**i)) % 256 for i in range(6) ]
-        code[0] = scriptcode_map.get(code[0],'INVALID')
-        sys.stderr.write("Evaluating: "+ str(code)+"\n")
+        # Fetch the instruction, decoding its code word once per contract root
+        if f.index in f.stored:
+            code = decode_instruction(f.storage.get(encode(f.index,256,32)))
+        elif f.index in program:
+            code = program[f.index]
+        else:
+            code = program[f.index] = decode_instruction(contract.get(encode(f.index,256,32)))
         # Invalid code instruction or STOP code stops execution sans fee
-        if val_at_index >= 256**6 or code[0] in ['STOP','INVALID']:
-            sys.stderr.write("stop code, exiting\n")
+        if code is None:
             break
+        op = code[0]
         # Calculate fee
-        minerfee = 0
+        minerfee = opcode_fees[op]
         nullfee = 0
         stepcounter += 1
         if stepcounter > 16:
             minerfee += params["stepfee"]
-        c = scriptcode_map[code[0]]
-        if c in ['STORE','LOAD']:
-            minerfee += params["datafee"]
-        if c in ['EXTRO','BALANCE']:
-            minerfee += params["extrofee"]
-        if c in ['SHA256','RIPEMD-160','ECMUL','ECADD','ECSIGN','ECRECOVER']:
-            minerfee += params["cryptofee"]
-        if c == 'STORE':
-            existing = block.get_contract_state(address,code[2])
-            if reg[code[1]] != 0: nullfee += params["memoryfee"]
+        if op == STORE:
+            existing = f.storage.get(encode(f.reg[code[2]],256,32))
+            if f.reg[code[1]] != 0: nullfee += params["memoryfee"]
             if existing: nullfee -= params["memoryfee"]
 
         # If we can't pay the fee, break, otherwise pay it
-        if block.get_balance(address) < minerfee + nullfee:
-            sys.stderr.write("insufficient fee, exiting\n")
+        if not meter.charge(minerfee,nullfee):
             break
-        block.set_balance(address,block.get_balance(address) - nullfee - minerfee)
-        block.reward += minerfee
-        sys.stderr.write("evaluating operation\n") 
+        if tracer is not None: tracer.on_step(f,code,minerfee+nullfee)
         # Evaluate operations
-        if c == 'ADD':
-            reg[code[3]] = (reg[code[1]] + reg[code[2]]) % 2**256
-        elif c == 'MUL':
-            reg[code[3]] = (reg[code[1]] * reg[code[2]]) % 2**256
-        elif c == 'SUB':
-            reg[code[3]] = (reg[code[1]] + 2**256 - reg[code[2]]) % 2**256
-        elif c == 'DIV':
-            reg[code[3]] = int(reg[code[1]] / reg[code[2]])
-        elif c == 'SDIV':
-            sign = 1
-            sign *= (1 if reg[code[1]] < 2**255 else -1)
-            sign *= (1 if reg[code[2]] < 2**255 else -1)
-            x = reg[code[1]] if reg[code[1]] < 2**255 else 2**256 - reg[code[1]]
-            y = reg[code[2]] if reg[code[2]] < 2**255 else 2**256 - reg[code[2]]
-            z = int(x/y)
-            reg[code[3]] = z if sign == 1 else 2**256 - z
-        elif code == 'MOD':
-            reg[code[3]] = reg[code[1]] % reg[code[2]]
-        elif code == 'SMOD':
-            sign = 1
-            sign *= (1 if reg[code[1]] < 2**255 else -1)
-            sign *= (1 if reg[code[2]] < 2**255 else -1)
-            x = reg[code[1]] if reg[code[1]] < 2**255 else 2**256 - reg[code[1]]
-            y = reg[code[2]] if reg[code[2]] < 2**255 else 2**256 - reg[code[2]]
-            z = x%y
-            reg[code[3]] = z if sign == 1 else 2**256 - z
-        elif code == 'EXP':
-            reg[code[3]] = pow(reg[code[1]],reg[code[2]],2**256)
-        elif code == 'NEG':
-            reg[code[2]] = 2**256 - reg[code[1]]
-        elif code == 'LT':
-            reg[code[3]] = 1 if reg[code[1]] < reg[code[2]] else 0
-        elif code == 'LE':
-            reg[code[3]] = 1 if reg[code[1]] <= reg[code[2]] else 0
-        elif code == 'GT':
-            reg[code[3]] = 1 if reg[code[1]] > reg[code[2]] else 0
-        elif code == 'GE':
-            reg[code[3]] = 1 if reg[code[1]] >= reg[code[2]] else 0
-        elif code == 'EQ':
-            reg[code[3]] = 1 if reg[code[1]] == reg[code[2]] else 0
-        elif code == 'NOT':
-            reg[code[2]] = 1 if reg[code[1]] == 0 else 0
-        elif code == 'SHA256':
-            inp = encode(reg[code[1]],256,32)
-            reg[code[2]] = decode(hashlib.sha256(inp).digest(),256)
-        elif code == 'RIPEMD-160':
-            inp = encode(reg[code[1]],256,32)
-            reg[code[2]] = decode(hashlib.new('ripemd160',inp).digest(),256)
-        elif code == 'ECMUL':
-            pt = (reg[code[1]],reg[code[2]])
-            # Point at infinity
-            if pt[0] == 0 and pt[1] == 0:
-                reg[code[4]], reg[code[5]] = 0,0
-            # Point not on curve, coerce to infinity
-            elif (pt[0] ** 3 + 7 - pt[1] ** 2) % N != 0:
-                reg[code[4]], reg[code[5]] = 0,0
-            # Legitimate point
-            else:
-                pt2 = base10_multiply(pt,reg[code[3]])
-                reg[code[4]], reg[code[5]] = pt2[0], pt2[1]
-        elif code == 'ECADD':
-            pt1 = (reg[code[1]],reg[code[2]])
-            pt2 = (reg[code[3]],reg[code[4]])
-            # Invalid point 1
-            if (pt1[0] ** 3 + 7 - pt1[1] ** 2) % N != 0:
-                reg[code[5]], reg[code[6]] = 0,0
-            # Invalid point 2
-            elif (pt2[0] ** 3 + 7 - pt2[1] ** 2) % N != 0:
-                reg[code[5]], reg[code[6]] = 0,0
-            # Legitimate points
-            else:
-                pt3 = base10_add(pt1,pt2)
-                reg[code[5]], reg[code[6]] = pt3[0], pt3[1]
-        elif code == 'ECSIGN':
-            reg[code[3]], reg[code[4]], reg[code[5]] = ecdsa_raw_sign(reg[code[1]],reg[code[2]])
-        elif code == 'ECRECOVER':
-            pt = ecdsa_raw_recover((reg[code[2]],reg[code[3]],reg[code[4]]),reg[code[1]])
-            reg[code[5]] = pt[0]
-            reg[code[6]] = pt[1]
-        elif code == 'COPY':
-            reg[code[2]] = reg[code[1]]
-        elif code == 'STORE':
-            contract.update(encode(reg[code[2]],256,32),reg[code[1]])
-        elif code == 'LOAD':
-            reg[code[2]] = contract.get(encode(reg[code[1]],256,32))
-        elif code == 'SET':
-            reg[code[1]] = (code[2] + 256 * code[3] + 65536 * code[4] + 16777216 * code[5]) * 2**code[6] % 2**256
-        elif code == 'JMP':
-            index = reg[code[1]]
-        elif code == 'JMPI':
-            if reg[code[1]]: index = reg[code[2]]
-        elif code == 'IND':
-            reg[code[1]] = index
-        elif code == 'EXTRO':
-            if reg[code[1]] >= 2**160:
-                reg[code[3]] = 0
-            else:
-                address = encode(reg[code[1]],256,20)
-                field = encode(reg[code[2]])
-                reg[code[3]] = block.get_contract(address).get(field)
-        elif code == 'BALANCE':
-            if reg[code[1]] >= 2**160:
-                reg[code[2]] = 0
-            else:
-                address = encode(reg[code[1]],256,20)
-                reg[code[2]] = block.get_balance(address)
-        elif code == 'MKTX':
-            to = encode(reg[code[1]],256,32)
-            value = reg[code[2]]
-            fee = reg[code[3]]
-            if (value + fee) > block.get_balance(address):
-                pass
-            else:
-                datan = reg[code[4]]
-                data = []
-                for i in range(datan):
-                    ind = encode((reg[code[5]] + i) % 2**256,256,32)
-                    data.append(contract.get(ind))
-                tx = Transaction(0,to,value,fee,data)
-                tx.sender = address
-                transaction_list.insert(0,tx)
-        elif code == 'DATA':
-            reg[code[2]] = tx.data[reg[code[1]]]
-        elif code == 'DATAN':
-            reg[code[1]] = len(tx.data)
-        elif code == 'MYADDRESS':
-            reg[code[1]] = address
-        elif code == 'BLKHASH':
-            reg[code[1]] = decode(block.hash())
-        elif code == 'SUICIDE':
-            sz = contract.get_size()
-            negfee = -sz * params["memoryfee"]
-            toaddress = encode(reg[code[1]],256,20)
-            block.pay_fee(roaddress,negfee,False)
-            contract.root = ''
-            break
+        f.next = f.index + 1
+        if settle_before[op]:
+            meter.settle()
+            stop = handlers[op](f,code)
+            meter.reload()
+        else:
+            stop = handlers[op](f,code)
+        if stop: break
+        f.index = f.next
+    meter.settle()
+    f.storage.flush()
+    # Instructions whose code words were not stored to remain valid
+    if f.stored and contract.root:
+        get_program(contract.root).update([ (i,c) for i,c in program.items() if i not in f.stored ])
     block.update_contract(address,contract)
@@ -1,59 +1,125 @@
+import os
+import stat
+
 def binary_length(n):
-    if n == 0: return 0
-    else: return 1 + binary_length(n / 256)
+    return (n.bit_length() + 7) / 8
 
 def to_binary_array(n,L=None):
-    if L is None: L = binary_length(n)
-    if n == 0: return []
-    else:
-        x = to_binary_array(n / 256)
-        x.append(n % 256)
-        return x
+    return [ord(x) for x in to_binary(n,L)]
 
-def to_binary(n,L=None): return ''.join([chr(x) for x in to_binary_array(n,L)])
+def to_binary(n,L=None):
+    if n == 0: return ''
+    h = '%x' % n
+    if len(h) % 2: h = '0' + h
+    return h.decode('hex')
 
 def from_binary(b):
     if len(b) == 0: return 0
-    else: return from_binary(b[:-1]) * 256 + ord(b[-1])
+    else: return int(b.encode('hex'),16)
 
-def __decode(s,pos=0):
-    if not s:
-        return (None, 0)
-    else:
-        fchar = ord(s[pos])
+def _leaf(buf,start,end):
+    x = buf[start:end]
+    return x if isinstance(x,str) else x.tobytes()
+
+def _prefix(buf,pos):
+    # Reads the prefix at pos; returns (kind, payload, start, end) where kind
+    # is 0 for an int, 1 for a string and 2 for a list. For ints and strings
+    # payload/start/end delimit the body, for lists payload is the item count.
+    try:
+        fchar = ord(buf[pos])
+    except IndexError:
+        raise Exception("unexpected end of data at position "+str(pos))
     if fchar < 24:
-        return (ord(s[pos]), pos+1)
+        return (0, fchar, pos+1, pos+1)
     elif fchar < 56:
-        b = ord(s[pos]) - 23
-        return (from_binary(s[pos+1:pos+1+b]), pos+1+b)
+        b = fchar - 23
+        return (0, None, pos+1, pos+1+b)
     elif fchar < 64:
-        b = ord(s[pos]) - 55
-        b2 = from_binary(s[pos+1:pos+1+b])
-        return (from_binary(s[pos+1+b:pos+1+b+b2]), pos+1+b+b2)
+        b = fchar - 55
+        b2 = from_binary(_leaf(buf,pos+1,pos+1+b))
+        return (0, None, pos+1+b, pos+1+b+b2)
     elif fchar < 120:
-        b = ord(s[pos]) - 64
-        return (s[pos+1:pos+1+b], pos+1+b)
+        b = fchar - 64
+        return (1, None, pos+1, pos+1+b)
     elif fchar < 128:
-        b = ord(s[pos]) - 119
-        b2 = from_binary(s[pos+1:pos+1+b])
-        return (s[pos+1+b:pos+1+b+b2], pos+1+b+b2)
+        b = fchar - 119
+        b2 = from_binary(_leaf(buf,pos+1,pos+1+b))
+        return (1, None, pos+1+b, pos+1+b+b2)
     elif fchar < 184:
-        b = ord(s[pos]) - 128
-        o, pos = [], pos+1
-        for i in range(b):
-            obj, pos = __decode(s,pos)
-            o.append(obj)
-        return (o,pos)
+        return (2, fchar - 128, pos+1, pos+1)
     elif fchar < 192:
-        b = ord(s[pos]) - 183
-        b2 = from_binary(s[pos+1:pos+1+b])
-        o, pos = [], pos+1+b
-        for i in range(b):
-            obj, pos = __decode(s,pos)
-            o.append(obj)
-        return (o,pos)
+        b = fchar - 183
+        return (2, from_binary(_leaf(buf,pos+1,pos+1+b)), pos+1+b, pos+1+b)
     else:
-        raise Exception("byte not supported: "+fchar)
+        raise Exception("byte not supported: "+str(fchar))
+
+def decode_at(buf,pos=0):
+    """
+    Decodes the RLP item starting at the given offset without copying the
+    surrounding buffer.
+
+    Args:
+        buf (str, buffer or memoryview): The buffer holding the encoded data.
+        pos (int): The offset of the item's first byte.
+
+    Returns:
+        tuple: The decoded object and the offset just past it.
+    """
+    # Slices of a buffer or memoryview must be copied out as strings
+    copy = not isinstance(buf,str)
+    if copy and isinstance(buf,bytearray):
+        buf, copy = str(buf), False
+    buflen = len(buf)
+    # The list being filled and how many items it still needs, with those
+    # of the lists it is nested in saved on the stack
+    cur, left, stack = None, 0, []
+    while 1:
+        try:
+            fchar = ord(buf[pos])
+        except IndexError:
+            raise Exception("unexpected end of data at position "+str(pos))
+        # Short strings, lists and ints, which make up nearly all of a
+        # trie node, are read here without going through _prefix
+        if 64 <= fchar < 120:
+            end = pos + fchar - 63
+            if end > buflen:
+                raise Exception("unexpected end of data at position "+str(buflen))
+            obj = buf[pos+1:end]
+            if copy: obj = obj.tobytes()
+            pos = end
+        elif 128 < fchar < 184:
+            if cur is not None: stack.append((cur,left))
+            cur, left = [], fchar - 128
+            pos += 1
+            continue
+        elif fchar < 24:
+            obj = fchar
+            pos += 1
+        else:
+            kind, payload, start, end = _prefix(buf,pos)
+            if end > buflen:
+                raise Exception("unexpected end of data at position "+str(buflen))
+            if kind == 2 and payload > 0:
+                if cur is not None: stack.append((cur,left))
+                cur, left = [], payload
+                pos = start
+                continue
+            if kind == 0:
+                obj = payload if payload is not None else from_binary(_leaf(buf,start,end))
+            elif kind == 1:
+                obj = _leaf(buf,start,end)
+            else:
+                obj = []
+            pos = end
+        # Attach the finished item to its list, closing every list it completes
+        while 1:
+            if cur is None:
+                return (obj, pos)
+            cur.append(obj)
+            left -= 1
+            if left: break
+            obj = cur
+            cur, left = stack.pop() if stack else (None, 0)
 
 def decode(s):
     """
@@ -65,41 +131,227 @@ def decode(s):
     Returns:
         object: The decoded object.
     """
-    return __decode(s)[0]
+    if not s:
+        return None
+    return decode_at(s,0)[0]
+
+def skip_at(buf,pos=0):
+    """
+    Returns the offset just past the RLP item starting at pos, without
+    building any of the decoded objects.
+    """
+    pending = 1
+    while pending:
+        kind, payload, start, end = _prefix(buf,pos)
+        pending -= 1
+        if kind == 2:
+            pending += payload
+            pos = start
+        else:
+            pos = end
+    if pos > len(buf):
+        raise Exception("unexpected end of data at position "+str(len(buf)))
+    return pos
+
+class LazyList():
+    """
+    Read-only view of an encoded RLP list that decodes items on access.
+
+    Item offsets are found by skipping over the encoding as far as needed,
+    and each decoded item is cached. Items that are themselves lists are
+    returned as LazyList views over the same buffer.
+
+    Attributes:
+        buf (str or memoryview): The buffer holding the encoded list.
+        pos (int): The offset of the list's prefix in buf.
+    """
+    def __init__(self,buf,pos=0):
+        kind, count, start, end = _prefix(buf,pos)
+        if kind != 2:
+            raise Exception("not an encoded list")
+        self.buf = buf
+        self.pos = pos
+        self.count = count
+        self.offsets = [start]
+        self.cache = {}
+
+    def __offset(self,i):
+        while len(self.offsets) <= i:
+            self.offsets.append(skip_at(self.buf,self.offsets[-1]))
+        return self.offsets[i]
+
+    def __len__(self): return self.count
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0: i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("list index out of range")
+        if i not in self.cache:
+            pos = self.__offset(i)
+            if ord(self.buf[pos]) >= 128:
+                self.cache[i] = LazyList(self.buf,pos)
+            else:
+                self.cache[i] = decode_at(self.buf,pos)[0]
+        return self.cache[i]
+
+    def __iter__(self):
+        for i in range(self.count): yield self[i]
+
+    def __eq__(self,other):
+        if isinstance(other,LazyList): other = other.to_list()
+        return self.to_list() == other
+
+    def __ne__(self,other): return not self == other
+
+    def __repr__(self): return 'LazyList(%r)' % self.to_list()
+
+    def end(self):
+        return self.__offset(self.count) if self.count else self.offsets[0]
+
+    def raw(self):
+        # Encoded bytes of the whole list, as they appear in the buffer
+        return _leaf(self.buf,self.pos,self.end())
+
+    def to_list(self):
+        return decode_at(self.buf,self.pos)[0]
+
+def decode_lazy(s):
+    """
+    Decodes the given RLP encoded string lazily.
+
+    Args:
+        s (str or memoryview): The RLP encoded string to decode.
+
+    Returns:
+        object: A LazyList if the item is a list, otherwise the decoded
+        string or integer.
+    """
+    if not s:
+        return None
+    if isinstance(s,bytearray): s = str(s)
+    if ord(s[0]) >= 128:
+        return LazyList(s)
+    return decode_at(s,0)[0]
+
+def _prefix_length(fchar):
+    # Number of bytes taken by a prefix starting with fchar
+    if 56 <= fchar < 64: return fchar - 54
+    elif 120 <= fchar < 128: return fchar - 118
+    elif 184 <= fchar < 192: return fchar - 182
+    return 1
+
+def _fill(read,buf,n):
+    # Reads onto the end of buf until it holds at least n bytes or the input
+    # runs out. read is given the number of bytes still missing
+    while len(buf) < n:
+        chunk = read(n - len(buf))
+        if not chunk: return
+        buf.extend(chunk)
+
+def _may_block(stream):
+    # Whether a read can wait for more than has arrived: true for pipes and
+    # sockets, false for regular files and in-memory streams
+    try:
+        mode = os.fstat(stream.fileno()).st_mode
+    except Exception:
+        return False
+    return not stat.S_ISREG(mode)
+
+def iter_decode(stream,raw=False,chunk_size=65536):
+    """
+    Decodes a stream of concatenated RLP items, yielding each top-level item
+    as soon as all of its bytes have arrived.
+
+    On pipes and sockets no more is read than the length prefixes require,
+    so an item is never held back waiting for the next one. Regular files
+    and in-memory streams are read in whole chunks.
+
+    Args:
+        stream (file or iterable): A file object with a read method, or an
+            iterable of byte chunks (e.g. successive socket reads).
+        raw (bool): If True, yield the encoded bytes of each item instead of
+            the decoded object.
+        chunk_size (int): Read size used for file objects.
+
+    Yields:
+        object: Each decoded item (or its encoding if raw is True).
+    """
+    if hasattr(stream,'read'):
+        if _may_block(stream):
+            read = lambda n: stream.read(min(n,chunk_size))
+        else:
+            read = lambda n: stream.read(chunk_size)
+    else:
+        chunks = iter(stream)
+        read = lambda n: next(chunks,'')
+    # Bytes read so far, and the offset of the current item in them
+    buf, base = bytearray(), 0
+    while 1:
+        # Drop consumed items once they are at least half the buffer
+        if base and 2 * base >= len(buf):
+            del buf[:base]
+            base = 0
+        _fill(read,buf,base+1)
+        if len(buf) <= base: return
+        pos, pending = base, 1
+        while pending:
+            _fill(read,buf,pos+1)
+            if len(buf) <= pos:
+                raise Exception("truncated RLP stream")
+            hlen = _prefix_length(buf[pos])
+            _fill(read,buf,pos+hlen)
+            if len(buf) < pos+hlen:
+                raise Exception("truncated RLP stream")
+            kind, payload, start, end = _prefix(str(buf[pos:pos+hlen]),0)
+            pending -= 1
+            if kind == 2:
+                pending += payload
+                pos += start
+            else:
+                pos += end
+        _fill(read,buf,pos)
+        if len(buf) < pos:
+            raise Exception("truncated RLP stream")
+        item = str(buf[base:pos])
+        base = pos
+        yield item if raw else decode_at(item,0)[0]
 
 def encode(s):
     """
     Encodes the given object using Recursive Length Prefix (RLP) encoding.
 
     Args:
-        s (object): The object to encode. It can be an integer, string, or list.
+        s (object): The object to encode. It can be an integer, string, or
+            list, or a LazyList, whose encoded bytes are copied as they are.
 
     Returns:
         str: The RLP encoded string.
     """
-    if isinstance(s,(int,long)):
-        if s < 0:
-            raise Exception("can't handle negative ints")
-        elif s >= 0 and s < 24:
-            return chr(s)
-        elif s <= 2**256:
-            b = to_binary(s)
-            return chr(len(b) + 23) + b
-        else:
-            b = to_binary(s)
-            b2 = to_binary(len(b))
-            return chr(len(b2) + 55) + b2 + b
-    elif isinstance(s,str):
+    # Strings first: they are most of every trie node
+    if isinstance(s,str):
         if len(s) < 56:
             return chr(len(s) + 64) + s
-        else:
-            b2 = to_binary(len(s))
-            return chr(len(b2) + 119) + b2 + s
+        b2 = to_binary(len(s))
+        return chr(len(b2) + 119) + b2 + s
     elif isinstance(s,list):
+        body = ''.join([ encode(x) for x in s ])
         if len(s) < 56:
-            return chr(len(s) + 128) + ''.join([encode(x) for x in s])
-        else:
-            b2 = to_binary(len(s))
-            return chr(len(b2) + 183) + b2 + ''.join([encode(x) for x in s])
+            return chr(len(s) + 128) + body
+        b2 = to_binary(len(s))
+        return chr(len(b2) + 183) + b2 + body
+    elif isinstance(s,(int,long)):
+        if s < 0:
+            raise Exception("can't handle negative ints")
+        elif s < 24:
+            return chr(s)
+        b = to_binary(s)
+        if len(b) <= 32:
+            return chr(len(b) + 23) + b
+        b2 = to_binary(len(b))
+        return chr(len(b2) + 55) + b2 + b
+    elif isinstance(s,LazyList):
+        return s.raw()
     else:
-        raise Exception("Encoding for "+s+" not yet implemented")
+        raise Exception("Encoding for "+repr(s)+" not yet implemented")
@@ -0,0 +1,141 @@
+from trie import Trie, parallel_root
+
+def _prefix_end(prefix):
+    # Smallest key greater than every key starting with prefix
+    while prefix and prefix[-1] == '\xff': prefix = prefix[:-1]
+    if not prefix: return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class Snapshot():
+    """
+    Flat key-value index of a committed state, kept alongside the state
+    trie so that reads cost one lookup instead of a walk from the root.
+
+    Accounts are stored under 'a' + address and contract storage slots under
+    's' + address + key. The index records the state root it matches, and
+    callers must only read from it when that root equals their own; the
+    trie remains the source of truth for roots and proofs.
+
+    Attributes:
+        store: The storage backend holding the index (see storage.py).
+        root (str): The state root the index currently reflects.
+    """
+    def __init__(self,store):
+        self.store = store
+        self.root = store.get('root')
+
+    def get_account(self,address): return self.store.get('a'+address)
+
+    def get_storage(self,address,key): return self.store.get('s'+address+key)
+
+    def apply(self,root,accounts,storage,cleared=()):
+        """
+        Moves the index forward to a new state in one atomic write.
+
+        Args:
+            root (str): The state root after the changes.
+            accounts (dict): Encoded account records by address; an empty
+                value deletes the account.
+            storage (dict): Slot values by (address, key); an empty value
+                deletes the slot.
+            cleared (iterable): Addresses whose storage was wiped before
+                the slot changes were made.
+        """
+        puts, deletes = {}, set()
+        for address in cleared:
+            prefix = 's'+address
+            for key, value in self.store.iterate(prefix,_prefix_end(prefix)):
+                deletes.add(key)
+        for address, value in accounts.items():
+            if value: puts['a'+address] = value
+            else: deletes.add('a'+address)
+        for (address, key), value in storage.items():
+            if value: puts['s'+address+key] = value
+            else: deletes.add('s'+address+key)
+        puts['root'] = root
+        self.store.write(puts.items(),[ k for k in deletes if k not in puts ])
+        self.root = root
+
+    def __expected(self,state,leaf_roots):
+        # Index entries implied by the given state trie, in no particular order
+        for address, value in state.iter_items():
+            yield 'a'+address, value
+            if leaf_roots:
+                for root in leaf_roots(value):
+                    for key, v in Trie(state.db,root).iter_items():
+                        yield 's'+address+key, v
+
+    def rebuild(self,state,leaf_roots=None,batch_size=1000):
+        """
+        Discards the index and rebuilds it from a state trie.
+
+        Args:
+            state (Trie): The state trie to index.
+            leaf_roots (callable): Maps an account record to the storage
+                roots it refers to, e.g. blocks.account_storage_roots.
+            batch_size (int): Number of entries written per batch.
+        """
+        # Mark the index invalid while it is being rewritten
+        self.store.write([('root','\x00')])
+        self.root = '\x00'
+        old = []
+        for key, value in self.store.iterate():
+            if key != 'root': old.append(key)
+            if len(old) >= batch_size:
+                self.store.write([],old)
+                old = []
+        self.store.write([],old)
+        batch = []
+        for item in self.__expected(state,leaf_roots):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                self.store.write(batch)
+                batch = []
+        batch.append(('root',state.root))
+        self.store.write(batch)
+        self.root = state.root
+
+    def compute_root(self,processes=None):
+        """
+        Recomputes the state root from the indexed account records alone,
+        hashing across a process pool. After a restore, comparing it with
+        the expected root checks the whole state without the state trie.
+
+        Args:
+            processes (int): Number of worker processes; all cores by default.
+
+        Returns:
+            str: The root of the state trie holding the indexed accounts.
+        """
+        accounts = [ (key[1:],value) for key, value in self.store.iterate('a','b') ]
+        return parallel_root(accounts,processes)
+
+    def verify(self,state,leaf_roots=None):
+        """
+        Checks the index against a state trie.
+
+        Args:
+            state (Trie): The state trie the index should reflect.
+            leaf_roots (callable): As for rebuild.
+
+        Returns:
+            list: The index keys that are missing, wrong or extra; empty if
+            the index is consistent.
+        """
+        bad = []
+        count, missing = 0, 0
+        for key, value in self.__expected(state,leaf_roots):
+            count += 1
+            stored = self.store.get(key)
+            if stored != value:
+                bad.append(key)
+                if stored == '': missing += 1
+        if self.root != state.root: bad.append('root')
+        nstored = 0
+        for key, value in self.store.iterate():
+            if key != 'root': nstored += 1
+        if nstored != count - missing:
+            expected = set([ k for k, v in self.__expected(state,leaf_roots) ])
+            for key, value in self.store.iterate():
+                if key != 'root' and key not in expected: bad.append(key)
+        return bad
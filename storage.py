@@ -0,0 +1,67 @@
+class LevelDBStore():
+    """
+    Key-value store kept in a LevelDB database on disk.
+
+    Attributes:
+        db (leveldb.LevelDB): The underlying database handle.
+    """
+    def __init__(self,path):
+        import leveldb
+        self.leveldb = leveldb
+        self.db = leveldb.LevelDB(path)
+
+    def get(self,key):
+        try: return self.db.Get(key)
+        except KeyError: return ''
+
+    def put(self,key,value): return self.db.Put(key,value)
+
+    def delete(self,key): return self.db.Delete(key)
+
+    def write(self,puts,deletes=()):
+        """
+        Applies the given writes atomically in one LevelDB WriteBatch.
+
+        Args:
+            puts (iterable): (key, value) pairs to store.
+            deletes (iterable): Keys to remove.
+        """
+        batch = self.leveldb.WriteBatch()
+        for key, value in puts: batch.Put(key,value)
+        for key in deletes: batch.Delete(key)
+        self.db.Write(batch)
+
+    def iterate(self,start=None,end=None):
+        """
+        Iterates over (key, value) pairs in key order, from start
+        (inclusive) to end (exclusive).
+        """
+        for key, value in self.db.RangeIter(key_from=start,key_to=end):
+            if end is not None and key >= end: return
+            yield key, value
+
+class MemoryStore():
+    """
+    Key-value store held in a dict, for tests and throwaway simulations.
+
+    Attributes:
+        data (dict): The stored key-value pairs.
+    """
+    def __init__(self,path=None):
+        self.data = {}
+
+    def get(self,key): return self.data.get(key,'')
+
+    def put(self,key,value): self.data[key] = value
+
+    def delete(self,key): self.data.pop(key,None)
+
+    def write(self,puts,deletes=()):
+        for key, value in puts: self.data[key] = value
+        for key in deletes: self.data.pop(key,None)
+
+    def iterate(self,start=None,end=None):
+        for key in sorted(self.data):
+            if start is not None and key < start: continue
+            if end is not None and key >= end: return
+            yield key, self.data[key]
@@ -0,0 +1,57 @@
+from blocks import Block
+from trie import DBRegistry
+from pybitcointools import bin_sha256, encode
+import storage
+import rlp
+
+def make_block():
+    header = [0,'',bin_sha256(rlp.encode([])),'','',bin_sha256(rlp.encode([])),2**36,0,0,'']
+    blk = Block(rlp.encode([header,[],[]]),DBRegistry(storage.MemoryStore))
+    blk.reward = 0
+    blk.touch('a'*20).balance = 100
+    blk.set_account('c'*20,rlp.encode([1,0,'']))
+    blk.commit()
+    return blk
+
+def store(blk,address,key,value):
+    contract = blk.get_contract(address)
+    contract.update(encode(key,256,32),encode(value,256))
+    blk.update_contract(address,contract)
+
+def test_nested_checkpoints():
+    blk = make_block()
+    root0 = blk.state.root
+    outer = blk.snapshot()
+    blk.touch('a'*20).balance -= 10
+    blk.touch('b'*20).balance += 10
+    blk.reward += 1
+    store(blk,'c'*20,1,5)
+    inner = blk.snapshot()
+    blk.touch('b'*20).balance += 50
+    store(blk,'c'*20,1,6)
+    blk.revert(inner)
+    assert blk.get_balance('b'*20) == 10
+    assert blk.get_contract_state('c'*20,encode(1,256,32)) == 5
+    inner = blk.snapshot()
+    blk.touch('a'*20).balance -= 1
+    blk.commit(inner)
+    assert blk.get_balance('a'*20) == 89
+    blk.revert(outer)
+    assert blk.state.root == root0 and blk.reward == 0
+    assert blk.get_balance('a'*20) == 100 and blk.get_balance('b'*20) == 0
+    assert blk.get_contract_state('c'*20,encode(1,256,32)) == 0
+    assert blk.checkpoints == [] and blk.undo == []
+
+def test_commit_requires_closed_checkpoints():
+    blk = make_block()
+    checkpoint = blk.snapshot()
+    blk.touch('b'*20).balance += 1
+    try:
+        blk.commit()
+    except Exception:
+        pass
+    else:
+        raise Exception("committed with an open checkpoint")
+    blk.commit(checkpoint)
+    blk.commit()
+    assert blk.get_balance('b'*20) == 1
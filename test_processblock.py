@@ -0,0 +1,111 @@
+from blocks import Block, account_storage_roots
+from snapshot import Snapshot
+from transactions import Transaction
+from trie import DBRegistry
+from pybitcointools import bin_sha256, encode
+import processblock
+import storage
+import random
+import rlp
+
+F = 2**64
+# Contract addresses fit in a SET register, so contracts can name them
+COUNTER = '\x00'*16 + 'cccc'
+MAKER = '\x00'*16 + 'mmmm'
+HASHER = '\x00'*16 + 'hhhh'
+DOOMED = '\x00'*16 + 'dddd'
+TARGET = '\x00'*16 + 'tttt'
+USERS = [ chr(65+i)*20 for i in range(20) ]
+
+def op(*args):
+    return encode(sum([ x << (8*i) for i, x in enumerate(args) ]),256)
+
+CODE = {
+    # storage[50] += 7
+    COUNTER: [ op(0x43,1,7), op(0x43,2,50), op(0x42,2,3), op(0x10,3,1,3),
+               op(0x41,3,2), op(0) ],
+    # Sends 5 to TARGET, run as a new transaction straight after this one
+    MAKER: [ op(0x43,1,0x74,0x74,0x74,0x74), op(0x43,2,5), op(0x43,3,0,0,1),
+             op(0x12,3,3,3), op(0x12,3,3,3), op(0x43,4,0), op(0x43,5,0),
+             op(0x70,1,2,3,4,5), op(0) ],
+    # storage[1] = the block hash
+    HASHER: [ op(0x91,1), op(0x43,2,1), op(0x41,1,2), op(0) ],
+    # storage[1] = 7, then destroys itself in favour of TARGET
+    DOOMED: [ op(0x43,1,7), op(0x43,2,1), op(0x41,1,2),
+              op(0x43,3,0x74,0x74,0x74,0x74), op(0xff,3) ],
+}
+
+def make_block(index=None):
+    header = [0,'',bin_sha256(rlp.encode([])),'m'*20,'',bin_sha256(rlp.encode([])),2**36,0,0,'']
+    blk = Block(rlp.encode([header,[],[]]),DBRegistry(storage.MemoryStore),index)
+    for address, code in CODE.items():
+        blk.set_account(address,rlp.encode([1,10*F,'']))
+        contract = blk.get_contract(address)
+        contract.update_many([ (encode(i,256,32),code[i]) for i in range(len(code)) ])
+        blk.update_contract(address,contract)
+    for address in USERS:
+        blk.set_account(address,rlp.encode([0,100*F,0]))
+    blk.commit()
+    return blk
+
+def make_transaction(sender,nonce,to,value=0):
+    tx = Transaction(nonce,to,value,2*F,[])
+    tx.sender = sender
+    tx.v, tx.r, tx.s = 0, 0, 0
+    return tx
+
+def make_transactions(seed):
+    rand = random.Random(seed)
+    nonces = {}
+    txs = []
+    for i in range(40):
+        sender = rand.choice(USERS)
+        to = rand.choice(USERS + [COUNTER, MAKER, HASHER, TARGET])
+        tx = make_transaction(sender,nonces.get(sender,0),to,rand.randrange(5)*F)
+        nonces[sender] = tx.nonce + 1
+        txs.append(tx)
+    return txs
+
+def test_parallel_eval_matches_serial():
+    hashed = False
+    for seed in range(4):
+        serial, parallel = make_block(), make_block()
+        processblock.eval(serial,make_transactions(seed),10**9,'x'*20)
+        processblock.eval(parallel,make_transactions(seed),10**9,'x'*20,processes=2)
+        assert parallel.state.root == serial.state.root
+        assert serial.get_contract_state(COUNTER,encode(50,256,32)) > 0
+        assert serial.get_balance(TARGET) % F > 0
+        hashed = hashed or serial.get_contract_state(HASHER,encode(1,256,32)) > 0
+    assert hashed
+
+def test_parallel_eval_without_conflicts():
+    # Every user pays itself, so no transaction sees another's writes
+    serial, parallel = make_block(), make_block()
+    txs = [ make_transaction(address,0,address,F) for address in USERS ]
+    processblock.eval(serial,list(txs),10**9,'x'*20)
+    processblock.eval(parallel,list(txs),10**9,'x'*20,processes=2)
+    assert parallel.state.root == serial.state.root
+    assert serial.account(USERS[0]).extra == 1
+
+def test_snapshot_index_follows_blocks():
+    index = Snapshot(storage.MemoryStore())
+    blk = make_block(index)
+    index.rebuild(blk.state,account_storage_roots)
+    txs = [ make_transaction(USERS[0],0,COUNTER), make_transaction(USERS[1],0,DOOMED),
+            make_transaction(USERS[2],0,USERS[3],F) ]
+    processblock.eval(blk,txs,10**9,'x'*20)
+    assert index.root == blk.state.root
+    assert index.verify(blk.state,account_storage_roots) == []
+    assert blk.get_storage(DOOMED,encode(1,256,32)) == ''
+    assert blk.get_contract_state(COUNTER,encode(50,256,32)) == 7
+
+def test_rawtx_does_not_stop_execution():
+    blk = make_block()
+    address = '\x00'*16 + 'rrrr'
+    blk.set_account(address,rlp.encode([1,10*F,'']))
+    code = [ op(0x71) ] + CODE[COUNTER]
+    contract = blk.get_contract(address)
+    contract.update_many([ (encode(i,256,32),code[i]) for i in range(len(code)) ])
+    blk.update_contract(address,contract)
+    processblock.eval(blk,[make_transaction(USERS[0],0,address)],10**9,'x'*20)
+    assert blk.get_contract_state(address,encode(50,256,32)) == 7
@@ -0,0 +1,79 @@
+import rlp
+import os
+import threading
+import StringIO
+
+SAMPLES = [ 0, 23, 24, 2**64, 2**256, 2**300, '', 'a', 'x'*55, 'x'*56, 'y'*300,
+            [], [[]], ['abc',[1,'',[2**70]],'x'*60], [ 'z'*32 for i in range(17) ],
+            range(60), [ [i,'n'*i] for i in range(58) ] ]
+
+def test_decode_roundtrip():
+    for obj in SAMPLES:
+        assert rlp.decode(rlp.encode(obj)) == obj
+
+def test_decode_at_offset():
+    for obj in SAMPLES:
+        enc = rlp.encode(obj)
+        buf = 'junk' + enc + enc
+        assert rlp.decode_at(buf,4) == (obj,4+len(enc))
+        assert rlp.decode_at(buf,4+len(enc)) == (obj,4+2*len(enc))
+        assert rlp.decode_at(memoryview(buf),4) == (obj,4+len(enc))
+        assert rlp.decode_at(bytearray(buf),4) == (obj,4+len(enc))
+
+def test_decode_at_truncated():
+    for obj in SAMPLES:
+        enc = rlp.encode(obj)
+        for cut in range(1,min(len(enc),4)):
+            try:
+                rlp.decode_at(enc[:-cut])
+            except Exception:
+                continue
+            raise Exception("decoded a truncated item")
+
+def test_decode_lazy():
+    obj = ['abc',[1,'',[2**70]],'x'*60,[]]
+    enc = rlp.encode(obj)
+    lazy = rlp.decode_lazy(enc)
+    assert len(lazy) == 4
+    assert lazy[0] == 'abc' and lazy[-2] == 'x'*60
+    assert isinstance(lazy[1],rlp.LazyList) and lazy[1][2][0] == 2**70
+    assert lazy[1].raw() == rlp.encode(obj[1])
+    assert lazy.to_list() == obj and list(lazy)[0] == 'abc' and lazy[1:3] == obj[1:3]
+    assert lazy.raw() == enc
+    # A lazy view re-encodes as its original bytes
+    assert rlp.encode(['head',lazy]) == rlp.encode(['head',obj])
+    assert rlp.decode_lazy(rlp.encode('abc')) == 'abc'
+    try:
+        lazy[4]
+    except IndexError:
+        return
+    raise Exception("read past the end of a lazy list")
+
+def test_iter_decode():
+    data = ''.join([ rlp.encode(obj) for obj in SAMPLES ])
+    assert list(rlp.iter_decode(StringIO.StringIO(data))) == SAMPLES
+    assert list(rlp.iter_decode(StringIO.StringIO(data),chunk_size=3)) == SAMPLES
+    # Chunks split anywhere, down to single bytes
+    for size in [1,7,1000]:
+        chunks = [ data[i:i+size] for i in range(0,len(data),size) ]
+        assert list(rlp.iter_decode(chunks,raw=True)) == [ rlp.encode(obj) for obj in SAMPLES ]
+    try:
+        list(rlp.iter_decode([data[:-1]]))
+    except Exception:
+        return
+    raise Exception("decoded a truncated stream")
+
+def test_iter_decode_pipe():
+    # An item is yielded once it has arrived, while the pipe is still open
+    r, w = os.pipe()
+    items = rlp.iter_decode(os.fdopen(r,'rb'))
+    got = []
+    os.write(w,rlp.encode(SAMPLES[-1]))
+    reader = threading.Thread(target=lambda: got.append(next(items)))
+    reader.daemon = True
+    reader.start()
+    reader.join(5)
+    os.write(w,rlp.encode('last'))
+    os.close(w)
+    assert got == [SAMPLES[-1]]
+    assert list(items) == ['last']
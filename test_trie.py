@@ -0,0 +1,135 @@
+from trie import Trie, DB, Pruner, verify_proof
+import storage
+import random
+
+def make_trie(n=200):
+    t = Trie(DB(storage.MemoryStore()))
+    for i in range(n):
+        t.update('key%d' % i,'value%d' % i)
+    return t
+
+def test_proof_of_present_key():
+    t = make_trie()
+    for key in ['key0','key7','key199']:
+        assert verify_proof(t.root,key,t.get_proof(key)) == t.get(key)
+
+def test_proof_of_absent_key():
+    t = make_trie()
+    for key in ['nokey','key','key2000']:
+        assert verify_proof(t.root,key,t.get_proof(key)) == ''
+
+def test_tampered_proof_is_rejected():
+    t = make_trie()
+    proof = t.get_proof('key7')
+    tampered = proof[:-1] + [proof[-1].replace('value7','value8')]
+    for bad in [tampered, proof[:-1], proof[1:]]:
+        try:
+            verify_proof(t.root,'key7',bad)
+        except Exception:
+            continue
+        raise Exception("accepted a bad proof")
+
+def test_pruner_keeps_recent_and_pinned_roots():
+    db = DB(storage.MemoryStore())
+    t = Trie(db)
+    pruner = Pruner(db,keep=2)
+    roots, contents = [], []
+    for r in range(5):
+        for i in range(50):
+            t.update('key%d' % i,'value%d.%d' % (i,r))
+        roots.append(t.root)
+        contents.append(t.to_dict())
+        pruner.add_root(t.root)
+    pruner.pin(roots[0])
+    assert pruner.prune() > 0
+    for r in [0,3,4]:
+        assert Trie(db,roots[r]).to_dict() == contents[r]
+    for r in [1,2]:
+        try:
+            Trie(db,roots[r]).to_dict()
+        except Exception:
+            continue
+        raise Exception("unreachable root was not collected")
+    # Once unpinned, the oldest root goes too
+    pruner.unpin(roots[0])
+    pruner.prune()
+    assert not db.get(roots[0])
+    assert Trie(db,roots[4]).to_dict() == contents[4]
+
+def check_builders_agree(inline_limit):
+    rand = random.Random(inline_limit)
+    items = {}
+    for i in range(500):
+        key = ''.join([chr(rand.randrange(256)) for j in range(rand.randrange(1,6))])
+        items[key] = 'v' * rand.randrange(1,40)
+    deleted = rand.sample(sorted(items),50)
+    t = Trie(DB(storage.MemoryStore()),inline_limit=inline_limit)
+    for key, value in items.items():
+        t.update(key,value)
+    for key in deleted:
+        t.update(key,'')
+        del items[key]
+    t2 = Trie(DB(storage.MemoryStore()),inline_limit=inline_limit)
+    t2.update_many([ (key,'x') for key in deleted ] + items.items())
+    t2.update_many([ (key,'') for key in deleted ])
+    t3 = Trie.from_sorted_items(DB(storage.MemoryStore()),sorted(items.items()),inline_limit)
+    roots = [ t.root, t2.root, t3.root ]
+    for processes in [1,2]:
+        t4 = Trie.from_items_parallel(DB(storage.MemoryStore()),items.items(),
+                                      processes=processes,inline_limit=inline_limit)
+        roots.append(t4.root)
+        assert t4.to_dict() == items
+    assert len(set(roots)) == 1
+    assert t3.to_dict() == items
+
+def test_builders_agree():
+    check_builders_agree(0)
+
+def test_builders_agree_with_inline_nodes():
+    check_builders_agree(32)
+
+def test_nested_checkpoints():
+    t = make_trie(20)
+    root0 = t.root
+    outer = t.snapshot()
+    t.update('key1','changed')
+    root1 = t.root
+    inner = t.snapshot()
+    t.update('key2','')
+    t.revert(inner)
+    assert t.root == root1 and t.get('key2') == 'value2'
+    inner = t.snapshot()
+    t.update('key3','changed')
+    t.commit(inner)
+    assert t.get('key3') == 'changed'
+    t.revert(outer)
+    assert t.root == root0 and t.get('key1') == 'value1' and t.get('key3') == 'value3'
+    assert t.checkpoints == []
+    # Committing the outer checkpoint closes the inner one with it
+    outer = t.snapshot()
+    t.snapshot()
+    t.update('key4','changed')
+    t.commit(outer)
+    assert t.checkpoints == [] and t.get('key4') == 'changed'
+    try:
+        t.revert(outer)
+    except Exception:
+        return
+    raise Exception("reverted to a closed checkpoint")
+
+def test_commit_keeps_other_tries_buffered_nodes():
+    db = DB(storage.MemoryStore())
+    db.buffer()
+    a, b = Trie(db), Trie(db)
+    for i in range(20):
+        a.update('key%d' % i,'a%d' % i)
+        b.update('key%d' % i,'b%d' % i)
+    checkpoint = b.snapshot()
+    b.update('key0','changed')
+    a.commit()
+    assert db.overlay is None
+    # b's nodes and the root it can still revert to were written too
+    assert Trie(db,b.root).get('key0') == 'changed'
+    b.revert(checkpoint)
+    assert b.to_dict() == dict([ ('key%d' % i,'b%d' % i) for i in range(20) ])
+    assert Trie(db,a.root).get('key19') == 'a19'
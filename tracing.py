@@ -0,0 +1,121 @@
+import json
+import time
+from processblock import scriptcode_map
+
+class Tracer():
+    """
+    Receives events from block and contract execution. Pass one as the
+    tracer argument of processblock.eval, process_transactions or
+    eval_contract; without one, execution makes no tracing calls at all.
+
+    Subclasses override the hooks they need; the defaults do nothing.
+    """
+    def on_tx_start(self,block,tx):
+        pass
+
+    def on_step(self,frame,code,fee):
+        """
+        Called for each contract instruction once its fees are paid, just
+        before it runs.
+
+        Args:
+            frame (processblock.Frame): The run's registers and position.
+            code (list): The opcode and its argument bytes.
+            fee (int): The fees charged for the step, refunds deducted.
+        """
+        pass
+
+    def on_tx_end(self,block,tx,status):
+        """
+        Called when a transaction finishes or is skipped.
+
+        Args:
+            status (str): 'ok', or why the transaction was skipped:
+                'insufficient fee', 'too much data', 'insufficient funds',
+                'bad nonce', 'contract exists' or 'error'.
+        """
+        pass
+
+    def on_block_end(self,block):
+        pass
+
+class JSONTracer(Tracer):
+    """
+    Writes every event as one JSON object per line.
+
+    Attributes:
+        stream (file): Where the lines are written.
+    """
+    def __init__(self,stream):
+        self.stream = stream
+
+    def __write(self,event):
+        self.stream.write(json.dumps(event,sort_keys=True)+'\n')
+
+    def on_tx_start(self,block,tx):
+        self.__write({ 'event': 'tx_start', 'sender': tx.sender.encode('hex'),
+                       'to': tx.to.encode('hex'), 'value': tx.value, 'fee': tx.fee })
+
+    def on_step(self,frame,code,fee):
+        self.__write({ 'event': 'step', 'address': frame.address.encode('hex'),
+                       'index': frame.index, 'op': scriptcode_map[code[0]],
+                       'args': code[1:], 'fee': fee })
+
+    def on_tx_end(self,block,tx,status):
+        self.__write({ 'event': 'tx_end', 'sender': tx.sender.encode('hex'),
+                       'status': status })
+
+    def on_block_end(self,block):
+        self.__write({ 'event': 'block_end', 'number': block.number,
+                       'reward': block.reward, 'state_root': block.state.root.encode('hex') })
+
+class OpcodeProfiler(Tracer):
+    """
+    Counts contract instructions by opcode, with the time spent on them and
+    a histogram of the fees they were charged.
+
+    An instruction's time runs from its on_step to the next event, so it
+    includes the interpreter's own overhead for that step.
+
+    Attributes:
+        counts (dict): Steps executed, by opcode name.
+        times (dict): Cumulative seconds, by opcode name.
+        fees (dict): For each opcode name, the number of steps by fee.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.times = {}
+        self.fees = {}
+        self.current = None
+        self.started = 0
+
+    def __stop(self):
+        # Charges the time since the last step to its opcode
+        if self.current is not None:
+            self.times[self.current] += time.time() - self.started
+            self.current = None
+
+    def on_step(self,frame,code,fee):
+        self.__stop()
+        name = scriptcode_map[code[0]]
+        if name not in self.counts:
+            self.counts[name], self.times[name], self.fees[name] = 0, 0.0, {}
+        self.counts[name] += 1
+        self.fees[name][fee] = self.fees[name].get(fee,0) + 1
+        self.current = name
+        self.started = time.time()
+
+    def on_tx_start(self,block,tx): self.__stop()
+
+    def on_tx_end(self,block,tx,status): self.__stop()
+
+    def on_block_end(self,block): self.__stop()
+
+    def report(self):
+        """
+        Returns:
+            list: (name, count, seconds, fee histogram) for each opcode,
+            most time first.
+        """
+        rows = [ (name,self.counts[name],self.times[name],self.fees[name]) for name in self.counts ]
+        return sorted(rows,key=lambda r: -r[2])
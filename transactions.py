@@ -2,10 +2,18 @@ from pybitcointools import *
 import rlp
 import re
 
-class Transaction():
+# Transaction fields that make up its encoding
+SERIALIZED_FIELDS = frozenset(['nonce','to','value','fee','data','v','r','s'])
+
+class Transaction(object):
     """
     Represents a transaction in the Ethereum blockchain.
 
+    The encoding and hash are cached, starting from the received bytes for
+    a parsed transaction when they are the canonical encoding, and dropped
+    whenever a field is assigned. Lists such as data must be replaced
+    rather than modified in place.
+
     Attributes:
         nonce (int): The transaction count of the sender.
         to (str): The address of the recipient.
@@ -17,8 +25,13 @@ class Transaction():
         s (int): The s value of the transaction signature.
         sender (str): The address of the sender.
     """
+    __slots__ = ['nonce','to','value','fee','data','v','r','s','sender',
+                 '__encoded','__hash']
+
     def __init__(*args):
         self = args[0]
+        self.__encoded = None
+        self.__hash = None
         if len(args) == 2:
             self.parse(args[1])
         else:
@@ -31,20 +44,29 @@ class Transaction():
     def parse(self,data):
         if re.match('^[0-9a-fA-F]*$',data):
             data = data.decode('hex')
-        o = rlp.unparse(data)
+        o = rlp.decode(data)
         self.nonce = o[0]
         self.to = o[1]
         self.value = o[2]
         self.fee = o[3]
-        self.data = rlp.decode(o[4])
+        self.data = o[4]
         self.v = o[5]
         self.r = o[6]
         self.s = o[7]
         rawhash = sha256(rlp.encode([self.nonce,self.to,self.value,self.fee,self.data]))
         pub = encode_pubkey(ecdsa_raw_recover(rawhash,(self.v,self.r,self.s)),'bin')
         self.sender = bin_sha256(pub[1:])[-20:]
+        # decode tolerates trailing bytes and non-canonical prefixes, so the
+        # received bytes only become the cached encoding if they are exact
+        if rlp.encode(o) == data: self.__encoded = data
         return self
 
+    def __setattr__(self,name,value):
+        if name in SERIALIZED_FIELDS:
+            object.__setattr__(self,'_Transaction__encoded',None)
+            object.__setattr__(self,'_Transaction__hash',None)
+        object.__setattr__(self,name,value)
+
     def sign(self,key):
         """
         Signs the transaction with the given private key.
@@ -55,16 +77,20 @@ class Transaction():
         Returns:
             Transaction: The signed transaction.
         """
-        rawhash = sha256(rlp.encode([self.to,self.value,self.fee,self.data]))
+        rawhash = sha256(rlp.encode([self.nonce,self.to,self.value,self.fee,self.data]))
         self.v,self.r,self.s = ecdsa_raw_sign(rawhash,key)
         self.sender = bin_sha256(privtopub(key)[1:])[-20:]
         return self
 
     def serialize(self):
-        return rlp.encode([self.nonce, self.to, self.value, self.fee, self.data, self.v, self.r, self.s])
+        if self.__encoded is None:
+            self.__encoded = rlp.encode([self.nonce, self.to, self.value, self.fee, self.data, self.v, self.r, self.s])
+        return self.__encoded
 
     def hex_serialize(self):
         return self.serialize().encode('hex')
 
     def hash(self):
-        return bin_sha256(self.serialize())
+        if self.__hash is None:
+            self.__hash = bin_sha256(self.serialize())
+        return self.__hash
@@ -1,18 +1,311 @@
-import leveldb
 import rlp
+import storage
+from nibbles import NibblePath, TERMINATOR, HEX
 import hashlib
+import multiprocessing
+import weakref
+from collections import OrderedDict, deque
 
 def sha256(x): return hashlib.sha256(x).digest()
 
+def _show(ref):
+    # Node reference as printed in debug output
+    return ref.encode('hex') if isinstance(ref,str) else repr(ref)
+
+# Default byte budget of the decoded-node cache kept by each DB
+NODE_CACHE_SIZE = 32 * 1024 * 1024
+
+class NodeCache():
+    """
+    Bounded LRU cache of decoded trie nodes keyed by node hash.
+
+    Nodes are content-addressed, so an entry never goes stale; entries are
+    only dropped when the total encoded size exceeds the byte budget.
+
+    Attributes:
+        max_size (int): The byte budget, measured on encoded node length.
+        size (int): The encoded size of the nodes currently cached.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that were not in the cache.
+    """
+    def __init__(self,max_size=NODE_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def get(self,key):
+        entry = self.entries.pop(key,None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self,key,node,size):
+        if key in self.entries or size > self.max_size: return
+        self.entries[key] = (node,size)
+        self.size += size
+        while self.size > self.max_size:
+            self.size -= self.entries.popitem(last=False)[1][1]
+
+    def discard(self,key):
+        entry = self.entries.pop(key,None)
+        if entry is not None: self.size -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
 class DB():
-    def __init__(self,dbfile): self.db = leveldb.LevelDB(dbfile)
+    """
+    Trie node database over a storage backend (see storage.py), with a
+    decoded-node cache and an optional in-memory write overlay.
+
+    While buffering, new nodes are kept in the overlay and reads are served
+    from it first; commit then writes only the nodes still reachable from
+    the given roots, or from any trie that has written to the overlay, in a
+    single atomic batch.
+    """
+    def __init__(self,store,cache_size=NODE_CACHE_SIZE):
+        if isinstance(store,str): store = storage.LevelDBStore(store)
+        self.store = store
+        self.cache = NodeCache(cache_size)
+        self.overlay = None
+        # Tries that have written to the overlay, whose nodes commit keeps
+        self.tries = weakref.WeakSet()
+        # Hashes written while a Pruner is collecting, which it must keep
+        self.live = None
     def get(self,key):
-        try: return self.db.Get(key)
-        except: return ''
-    def put(self,key,value): return self.db.Put(key,value)
-    def delete(self,key): return self.db.Delete(key)
+        if self.overlay is not None and key in self.overlay:
+            return self.overlay[key]
+        return self.store.get(key)
+    def put(self,key,value): return self.store.put(key,value)
+    def delete(self,key): return self.store.delete(key)
+    # Returns the decoded node stored under the given hash. The result is
+    # shared with other callers and must not be modified.
+    def get_node(self,key):
+        node = self.cache.get(key)
+        if node is None:
+            rlpnode = self.get(key)
+            node = rlp.decode(rlpnode)
+            if node: self.cache.put(key,node,len(rlpnode))
+        return node
+    def put_node(self,key,node,rlpnode):
+        if self.overlay is not None: self.overlay[key] = rlpnode
+        else: self.put(key,rlpnode)
+        if self.live is not None: self.live.add(key)
+        self.cache.put(key,node,len(rlpnode))
+    # Stores many (hash, encoded node) pairs in one batch, bypassing the cache
+    def put_nodes(self,nodes):
+        if self.overlay is not None: self.overlay.update(nodes)
+        else: self.store.write(nodes)
+        if self.live is not None: self.live.update([ h for h, rlpnode in nodes ])
+
+    def buffer(self):
+        """
+        Starts collecting node writes in memory until the next commit.
+        """
+        if self.overlay is None: self.overlay = {}
+
+    def commit(self,roots):
+        """
+        Writes the buffered nodes reachable from the given roots to the
+        database in one batch, discards the rest and stops buffering.
+
+        Nodes of every trie that has written to the overlay are kept as well,
+        at its current root and at any root saved by an open checkpoint, so
+        that committing one trie never loses another's state.
+
+        Args:
+            roots (list): Root hashes of further tries whose state must be
+                kept, e.g. ones whose Trie objects are gone.
+
+        Returns:
+            int: The number of nodes written.
+        """
+        if self.overlay is None: return 0
+        stack = list(roots)
+        for t in self.tries:
+            stack.append(t.root)
+            stack.extend([ root for root, journal in t.checkpoints ])
+        written = set()
+        while stack:
+            h = stack.pop()
+            if h in written or h not in self.overlay: continue
+            written.add(h)
+            rlpnode = self.overlay[h]
+            stack.extend(child_hashes(rlp.decode(rlpnode)))
+        self.store.write([ (h,self.overlay[h]) for h in written ])
+        if self.live is not None: self.live.update(written)
+        for h in self.overlay:
+            if h not in written: self.cache.discard(h)
+        self.overlay = None
+        self.tries = weakref.WeakSet()
+        return len(written)
+
+def child_hashes(node):
+    """
+    Returns the hashes of the stored nodes that a decoded node refers to,
+    looking inside any children embedded in it (see Trie.inline_limit).
+    """
+    out = []
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        if len(node) == 17: refs = node[:16]
+        elif ord(node[0][0]) < 2: refs = [node[1]]
+        else: continue
+        for ref in refs:
+            if isinstance(ref,list): todo.append(ref)
+            elif ref: out.append(ref)
+    return out
 
-databases = {}
+class Pruner():
+    """
+    Incremental mark-and-sweep garbage collector for a node database.
+
+    Keeps every node reachable from the last few state roots and from any
+    pinned roots, and deletes the rest in batches. A collection runs a
+    batch at a time through step(), so it can be interleaved with block
+    processing; nodes written meanwhile are always kept.
+
+    Tries that share content-addressed nodes are safe because a node is
+    only deleted when no retained root reaches it. Roots stored inside leaf
+    values (e.g. contract storage roots in account records) are found
+    through the leaf_roots callback.
+
+    Attributes:
+        db (DB): The database to collect.
+        keep (int): Number of recent roots retained.
+        leaf_roots (callable): Maps a leaf value of a retained trie to the
+            roots of the tries it refers to. The leaves of those tries are
+            not inspected further.
+        deleted (int): Total number of nodes deleted so far.
+    """
+    def __init__(self,db,keep=256,leaf_roots=None):
+        self.db = db
+        self.keep = keep
+        self.leaf_roots = leaf_roots
+        self.recent = deque()
+        self.pinned = {}
+        self.deleted = 0
+        self.gc = None
+
+    def add_root(self,root):
+        if not root: return
+        self.recent.append(root)
+        while len(self.recent) > self.keep: self.recent.popleft()
+
+    def pin(self,root):
+        self.pinned[root] = self.pinned.get(root,0) + 1
+
+    def unpin(self,root):
+        if self.pinned.get(root,0) <= 1: self.pinned.pop(root,None)
+        else: self.pinned[root] -= 1
+
+    def __collect(self,batch_size):
+        live = set()
+        self.db.live = live
+        # Mark
+        stack = [ (r,True) for r in set(self.recent) | set(self.pinned) ]
+        seen = set()
+        visited = 0
+        while stack:
+            h, expand = stack.pop()
+            if isinstance(h,list):
+                # Embedded in its parent, which is already marked
+                curnode = h
+            else:
+                if (h,expand) in seen: continue
+                seen.add((h,expand))
+                # Read past the node cache, so a collection does not evict
+                # the working set
+                curnode = rlp.decode(self.db.get(h))
+                if not curnode: continue
+                live.add(h)
+            if len(curnode) == 17:
+                stack.extend([ (c,expand) for c in curnode[:16] if c ])
+                value = curnode[16]
+            elif ord(curnode[0][0]) < 2:
+                stack.append((curnode[1],expand))
+                value = ''
+            else:
+                value = curnode[1]
+            if value and expand and self.leaf_roots:
+                stack.extend([ (r,False) for r in self.leaf_roots(value) if r ])
+            visited += 1
+            if visited % batch_size == 0: yield 0
+        # Sweep
+        dead = []
+        for key, value in self.db.store.iterate():
+            if key not in live: dead.append(key)
+            if len(dead) >= batch_size:
+                yield self.__delete(dead,live)
+                dead = []
+        yield self.__delete(dead,live)
+        self.db.live = None
+
+    def __delete(self,dead,live):
+        dead = [ h for h in dead if h not in live ]
+        self.db.store.write([],dead)
+        for h in dead: self.db.cache.discard(h)
+        self.deleted += len(dead)
+        return len(dead)
+
+    def step(self,batch_size=1000):
+        """
+        Runs one batch of the current collection, starting a new one if
+        none is in progress.
+
+        Returns:
+            int: The number of nodes deleted by this batch.
+        """
+        if self.gc is None: self.gc = self.__collect(batch_size)
+        try:
+            return next(self.gc)
+        except StopIteration:
+            self.gc = None
+            return 0
+
+    def prune(self,batch_size=1000):
+        """
+        Runs a whole collection to completion.
+
+        Returns:
+            int: The number of nodes deleted.
+        """
+        self.gc = None
+        total = 0
+        gc = self.__collect(batch_size)
+        for n in gc: total += n
+        return total
+
+class DBRegistry():
+    """
+    Opens node databases by name and hands out one shared DB per name, so
+    that every trie on the same database shares its cache and overlay.
+
+    Attributes:
+        backend (callable): Makes a store from a name, e.g.
+            storage.LevelDBStore or storage.MemoryStore.
+        cache_size (int): Byte budget of each DB's node cache.
+        databases (dict): The DB opened for each name.
+    """
+    def __init__(self,backend=storage.LevelDBStore,cache_size=NODE_CACHE_SIZE):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.databases = {}
+
+    def get(self,name):
+        if name not in self.databases:
+            self.databases[name] = DB(self.backend(name),self.cache_size)
+        return self.databases[name]
+
+# Used when a Trie or Block is given a database name rather than a DB
+default_registry = DBRegistry()
 
 class Trie():
     """
@@ -21,50 +314,64 @@ class Trie():
     Attributes:
         root (str): The root hash of the trie.
         debug (bool): Flag to enable or disable debug mode.
-        db (DB): The database instance used for storing trie nodes.
+        db (DB): The database instance used for storing trie nodes. A
+            database name may be passed instead, which is opened through
+            default_registry.
+        inline_limit (int): Child nodes whose encoding is shorter than this
+            many bytes are embedded in their parent instead of being stored
+            under their hash. The root is always stored. 0 (the default)
+            stores every node; note that the setting changes root hashes.
     """
-    def __init__(self,dbfile,root='',debug=False):
+    def __init__(self,db,root='',debug=False,inline_limit=0):
         self.root = root
         self.debug = debug
-        if dbfile not in databases:
-            databases[dbfile] = DB(dbfile)
-        self.db = databases[dbfile]
-
-    def __encode_key(self,key):
-        term = 1 if key[-1] == 16 else 0
-        oddlen = (len(key) - term) % 2
-        prefix = ('0' if oddlen else '')
-        main = ''.join(['0123456789abcdef'[x] for x in key[:len(key)-term]])
-        return chr(2 * term + oddlen) + (prefix+main).decode('hex')
-
-    def __decode_key(self,key):
-        o = ['0123456789abcdef'.find(x) for x in key[1:].encode('hex')]
-        if key[0] == '\x01' or key[0] == '\x03': o = o[1:]
-        if key[0] == '\x02' or key[0] == '\x03': o.append(16)
-        return o
-        
+        if isinstance(db,str): db = default_registry.get(db)
+        self.db = db
+        self.inline_limit = inline_limit
+        # When a dict, records every key written through update/update_many
+        self.journal = None
+        # (root, journal) saved by each open checkpoint, oldest first
+        self.checkpoints = []
+
     def __get_state(self,node,key):
-        if self.debug: print 'nk',node.encode('hex'),key
+        if self.debug: print 'nk',_show(node),key
         if len(key) == 0 or not node:
             return node
-        curnode = rlp.decode(self.db.get(node))
+        curnode = self.__get_node(node)
         if self.debug: print 'cn', curnode
         if not curnode:
             raise Exception("node not found in database")
         elif len(curnode) == 2:
             (k2,v2) = curnode
-            k2 = self.__decode_key(k2)
-            if len(key) >= len(k2) and k2 == key[:len(k2)]:
+            k2 = NibblePath.from_encoded(k2)
+            if key.startswith(k2):
                 return self.__get_state(v2,key[len(k2):])
             else:
                 return ''
         elif len(curnode) == 17:
             return self.__get_state(curnode[key[0]],key[1:])
 
+    def __get_node(self,ref):
+        # A child reference is either a node hash or an embedded node
+        if isinstance(ref,list): return ref
+        return self.db.get_node(ref)
+
     def __put(self,node):
         rlpnode = rlp.encode(node)
+        if len(rlpnode) < self.inline_limit: return node
+        h = sha256(rlpnode)
+        self.db.put_node(h,node,rlpnode)
+        return h
+
+    def __put_root(self,ref):
+        # Stores a root left embedded by __put, so that roots are always
+        # hashes. Every write ends here, so this is also where the trie asks
+        # a buffering DB to keep its nodes on commit
+        if self.db.overlay is not None: self.db.tries.add(self)
+        if not isinstance(ref,list): return ref
+        rlpnode = rlp.encode(ref)
         h = sha256(rlpnode)
-        self.db.put(h,rlpnode)
+        self.db.put_node(h,ref,rlpnode)
         return h
 
     def __update_state(self,node,key,value):
@@ -72,26 +379,25 @@ class Trie():
         else: return self.__delete_state(node,key)
 
     def __insert_state(self,node,key,value):
-        if self.debug: print 'ink', node.encode('hex'), key
+        if self.debug: print 'ink', _show(node), key
         if len(key) == 0:
             return value
         else:
             if not node:
-                newnode = [ self.__encode_key(key), value ]
+                newnode = [ key.encode(), value ]
                 return self.__put(newnode)
-            curnode = rlp.decode(self.db.get(node))
+            curnode = self.__get_node(node)
             if self.debug: print 'icn', curnode
             if not curnode:
                 raise Exception("node not found in database")
             if len(curnode) == 2:
                 (k2, v2) = curnode
-                k2 = self.__decode_key(k2)
+                k2 = NibblePath.from_encoded(k2)
                 if key == k2:
-                    newnode = [ self.__encode_key(key), value ]
+                    newnode = [ key.encode(), value ]
                     return self.__put(newnode)
                 else:
-                    i = 0
-                    while key[:i+1] == k2[:i+1] and i < len(k2): i += 1
+                    i = key.common_prefix(k2)
                     if i == len(k2):
                         newhash3 = self.__insert_state(v2,key[i:],value)
                     else:
@@ -104,7 +410,7 @@ class Trie():
                     if i == 0:
                         return newhash3
                     else:
-                        newnode4 = [ self.__encode_key(key[:i]), newhash3 ]
+                        newnode4 = [ key[:i].encode(), newhash3 ]
                         return self.__put(newnode4)
             else:
                 newnode = [ curnode[i] for i in range(17) ]
@@ -112,25 +418,25 @@ class Trie():
                 return self.__put(newnode)
     
     def __delete_state(self,node,key):
-        if self.debug: print 'dnk', node.encode('hex'), key
+        if self.debug: print 'dnk', _show(node), key
         if len(key) == 0 or not node:
             return ''
         else:
-            curnode = rlp.decode(self.db.get(node))
+            curnode = self.__get_node(node)
             if not curnode:
                 raise Exception("node not found in database")
             if self.debug: print 'dcn', curnode
             if len(curnode) == 2:
                 (k2, v2) = curnode
-                k2 = self.__decode_key(k2)
+                k2 = NibblePath.from_encoded(k2)
                 if key == k2:
                     return ''
-                elif key[:len(k2)] == k2:
+                elif key.startswith(k2):
                     newhash = self.__delete_state(v2,key[len(k2):])
-                    childnode = rlp.decode(self.db.get(newhash))
+                    childnode = self.__get_node(newhash)
                     if len(childnode) == 2:
-                        newkey = k2 + self.__decode_key(childnode[0])
-                        newnode = [ self.__encode_key(newkey), childnode[1] ]
+                        newkey = k2 + NibblePath.from_encoded(childnode[0])
+                        newnode = [ newkey.encode(), childnode[1] ]
                     else:
                         newnode = [ curnode[0], newhash ]
                     return self.__put(newnode)
@@ -143,27 +449,197 @@ class Trie():
                     if newnode[i]:
                         if onlynode == -1: onlynode = i
                         else: onlynode = -2
-                if onlynode >= 0:
-                    childnode = rlp.decode(self.db.get(newnode[onlynode]))
+                if onlynode == 16:
+                    newnode2 = [ TERMINATOR.encode(), newnode[16] ]
+                elif onlynode >= 0:
+                    childnode = self.__get_node(newnode[onlynode])
                     if not childnode:
                         raise Exception("?????")
                     if len(childnode) == 17:
-                        newnode2 = [ key[0], newnode[onlynode] ]
+                        newnode2 = [ NibblePath.from_nibbles([onlynode]).encode(), newnode[onlynode] ]
                     elif len(childnode) == 2:
-                        newkey = [onlynode] + self.__decode_key(childnode[0])
-                        newnode2 = [ self.__encode_key(newkey), childnode[1] ]
+                        newkey = NibblePath.from_nibbles([onlynode]) + NibblePath.from_encoded(childnode[0])
+                        newnode2 = [ newkey.encode(), childnode[1] ]
                 else:
                     newnode2 = newnode
                 return self.__put(newnode2)
 
+    def __groups(self,items):
+        # Splits sorted (key, value) pairs into runs sharing a first nibble,
+        # yielding each nibble with the run's keys shortened by one
+        i = 0
+        while i < len(items):
+            n = items[i][0][0]
+            j = i
+            while j < len(items) and items[j][0][0] == n: j += 1
+            yield n, [ (k[1:],v) for k,v in items[i:j] ]
+            i = j
+
+    def __build(self,items):
+        # Builds a fresh subtree holding the non-empty values in items
+        items = [ (k,v) for k,v in items if v != '' ]
+        if not items:
+            return ''
+        if len(items) == 1:
+            return self.__put([ items[0][0].encode(), items[0][1] ])
+        first, last = items[0][0], items[-1][0]
+        i = first.common_prefix(last)
+        newnode = [ '' ] * 17
+        for n, sub in self.__groups([ (k[i:],v) for k,v in items ]):
+            if n == 16: newnode[16] = sub[-1][1]
+            else: newnode[n] = self.__build(sub)
+        if i == 0:
+            return self.__put(newnode)
+        return self.__put([ first[:i].encode(), self.__put(newnode) ])
+
+    def __split(self,items,d,levels,jobs,results):
+        # Lays out the top levels of the subtree __build would make for
+        # items, (path, key, value) triples with d nibbles already consumed.
+        # Deeper subtrees become jobs; when results is given, the finished
+        # subtrees are taken from it in the same order and the top nodes put.
+        if levels == 0 or len(items) == 1:
+            if results is None:
+                jobs.append(([ (k,v) for p,k,v in items ],d))
+                return None
+            return next(results)
+        first, last = items[0][0][d:], items[-1][0][d:]
+        i = first.common_prefix(last)
+        newnode = [ '' ] * 17
+        j = 0
+        while j < len(items):
+            n = items[j][0][d+i]
+            k = j
+            while k < len(items) and items[k][0][d+i] == n: k += 1
+            if n == 16: newnode[16] = items[k-1][2]
+            else: newnode[n] = self.__split(items[j:k],d+i+1,levels-1,jobs,results)
+            j = k
+        if results is None: return None
+        if i == 0:
+            return self.__put(newnode)
+        return self.__put([ first[:i].encode(), self.__put(newnode) ])
+
+    def _build_subtree(self,items,d):
+        # Worker side of from_items_parallel: builds the subtree for sorted
+        # (key, value) pairs past their first d nibbles
+        return self.__stream([ (NibblePath.from_key(k)[d:],v) for k,v in items ])
+
+    def __extend(self,key,child):
+        # Puts an extension over child, merging it into a leaf or extension child
+        if not child:
+            return ''
+        childnode = self.__get_node(child)
+        if len(childnode) == 2:
+            newkey = key + NibblePath.from_encoded(childnode[0])
+            return self.__put([ newkey.encode(), childnode[1] ])
+        return self.__put([ key.encode(), child ])
+
+    def __collapse(self,newnode):
+        # Puts a branch, replacing it if it has fewer than two entries left
+        onlynode = -1
+        for i in range(17):
+            if newnode[i]:
+                if onlynode == -1: onlynode = i
+                else: return self.__put(newnode)
+        if onlynode == -1:
+            return ''
+        elif onlynode == 16:
+            return self.__put([ TERMINATOR.encode(), newnode[16] ])
+        return self.__extend(NibblePath.from_nibbles([onlynode]),newnode[onlynode])
+
+    def __apply(self,node,items,curnode=None):
+        # Applies sorted, distinct (key, value) pairs under node and returns
+        # the new node hash. curnode may give the decoded node directly, with
+        # node None when that node has not been stored yet.
+        if curnode is None:
+            if not items: return node
+            if not node: return self.__build(items)
+            curnode = self.__get_node(node)
+            if not curnode:
+                raise Exception("node not found in database")
+        elif not items:
+            return self.__put(curnode)
+        if len(curnode) == 17:
+            newnode = list(curnode)
+            for n, sub in self.__groups(items):
+                if n == 16: newnode[16] = sub[-1][1]
+                else: newnode[n] = self.__apply(curnode[n],sub)
+            if newnode == curnode:
+                return node if node is not None else self.__put(curnode)
+            return self.__collapse(newnode)
+        k2 = NibblePath.from_encoded(curnode[0])
+        if k2.term:
+            # Leaf: rebuild it together with the updates, unless overridden
+            keys = [ k for k,v in items ]
+            if k2 not in keys:
+                items = sorted(items + [ (k2,curnode[1]) ],key=lambda kv: kv[0].hex())
+            return self.__build(items)
+        # Extension: find how far the updates agree with its key
+        i = len(k2)
+        for k,v in items:
+            i = min(i,k.common_prefix(k2))
+        if i == len(k2):
+            newchild = self.__apply(curnode[1],[ (k[i:],v) for k,v in items ])
+            if newchild == curnode[1]:
+                return node if node is not None else self.__put(curnode)
+            return self.__extend(k2,newchild)
+        if i > 0:
+            rest = [ k2[i:].encode(), curnode[1] ]
+            return self.__extend(k2[:i],self.__apply(None,[ (k[i:],v) for k,v in items ],rest))
+        # The updates diverge at the first nibble: split into a branch
+        if len(k2) == 1:
+            child, childnode = curnode[1], None
+        else:
+            child, childnode = None, [ k2[1:].encode(), curnode[1] ]
+        newnode = [ '' ] * 17
+        oldsub = []
+        for n, sub in self.__groups(items):
+            if n == 16: newnode[16] = sub[-1][1]
+            elif n == k2[0]: oldsub = sub
+            else: newnode[n] = self.__build(sub)
+        newnode[k2[0]] = self.__apply(child,oldsub,childnode)
+        return self.__collapse(newnode)
+
+    def __close(self,stack,key,value,c):
+        # Hangs the leaf for key under the open branches, then closes every
+        # branch deeper than c, the length of key's common prefix with the
+        # next key (-1 when there is none). Returns the root once all close.
+        if not stack and c < 0:
+            return self.__put([ key.encode(), value ])
+        if not stack or c > stack[-1][0]:
+            stack.append([ c, [ '' ] * 17 ])
+        d, node = stack[-1]
+        if key[d] == 16: node[16] = value
+        else: node[key[d]] = self.__put([ key[d+1:].encode(), value ])
+        while stack and stack[-1][0] > c:
+            d, node = stack.pop()
+            h = self.__put(node)
+            if c >= 0 and (not stack or stack[-1][0] < c):
+                stack.append([ c, [ '' ] * 17 ])
+            if stack:
+                p = stack[-1][0]
+                if d > p + 1: h = self.__put([ key[p+1:d].encode(), h ])
+                stack[-1][1][key[p]] = h
+            else:
+                return h if d == 0 else self.__put([ key[:d].encode(), h ])
+
+    def __stream(self,pairs):
+        # Builds a subtree from (path, value) pairs in increasing path order
+        stack = []
+        prev, prevvalue = None, None
+        for path, value in pairs:
+            if prev is not None:
+                self.__close(stack,prev,prevvalue,prev.common_prefix(path))
+            prev, prevvalue = path, value
+        if prev is None: return ''
+        return self.__close(stack,prev,prevvalue,-1)
+
     def __get_size(self,node):
         if not node: return 0
-        curnode = self.db.get(node)
+        curnode = self.__get_node(node)
         if not curnode:
             raise Exception("node not found in database")
         if len(curnode) == 2:
-            key = self.__decode_key(curnode[0])
-            if key[-1] == 16: return 1
+            if NibblePath.from_encoded(curnode[0]).term: return 1
             else: return self.__get_size(curnode[1])
         elif len(curnode) == 17:
             total = 0
@@ -172,51 +648,140 @@ class Trie():
             if curnode[16]: total += 1
             return total
 
-    def __to_dict(self,node):
-        if not node: return {}
-        curnode = rlp.decode(self.db.get(node))
-        if not curnode:
-            raise Exception("node not found in database")
-        if len(curnode) == 2:
-            lkey = self.__decode_key(curnode[0])
-            o = {}
-            if lkey[-1] == 16:
-                o[curnode[0]] = curnode[1]   
+    def iter_items(self,prefix=None,start=None,end=None):
+        """
+        Iterates over the trie's (key, value) pairs in key order.
+
+        Nodes are walked depth-first and decoded only as the walk reaches
+        them, and subtrees outside the requested range are skipped.
+
+        Args:
+            prefix (str): Only yield keys starting with this prefix.
+            start (str): Only yield keys greater than or equal to this key.
+            end (str): Only yield keys strictly less than this key.
+
+        Yields:
+            tuple: (key, value) pairs.
+        """
+        # Paths are kept as hex strings, which order like the nibbles
+        lower = ''
+        if start is not None:
+            lower = start.encode('hex')
+        if prefix is not None:
+            pnib = prefix.encode('hex')
+            if pnib > lower: lower = pnib
+        if not self.root: return
+        stack = [ (0, '', self.root) ]
+        while stack:
+            kind, path, x = stack.pop()
+            # Skip subtrees below the range, stop once past the prefix
+            m = min(len(path),len(lower))
+            if path[:m] < lower[:m]: continue
+            if prefix is not None and path[:len(pnib)] != pnib[:len(path)]:
+                return
+            if kind == 1:
+                if path < lower: continue
+                key = path.decode('hex')
+                if end is not None and key >= end: return
+                yield key, x
+                continue
+            curnode = self.__get_node(x)
+            if not curnode:
+                raise Exception("node not found in database")
+            if len(curnode) == 2:
+                k2 = NibblePath.from_encoded(curnode[0])
+                if k2.term: stack.append((1, path + k2.hex(), curnode[1]))
+                else: stack.append((0, path + k2.hex(), curnode[1]))
+            elif len(curnode) == 17:
+                for i in range(15,-1,-1):
+                    if curnode[i]: stack.append((0, path + HEX[i], curnode[i]))
+                if curnode[16]: stack.append((1, path, curnode[16]))
             else:
-                d = self.__to_dict(curnode[1])
-                for v in d:
-                    subkey = self.__decode_key(v)
-                    totalkey = self.__encode_key(lkey+subkey)
-                    o[totalkey] = d[v]
-            return o
-        elif len(curnode) == 17:
-            o = {}
-            for i in range(16):
-                d = self.__to_dict(curnode[i])
-                for v in d:
-                    subkey = self.__decode_key(v)
-                    totalkey = self.__encode_key([i] + subkey)
-                    o[totalkey] = d[v]
-            if curnode[16]: o[chr(16)] = curnode[16]
-            return o
-        else:
-            raise Exception("bad curnode! "+curnode)
+                raise Exception("bad curnode! "+repr(curnode))
 
     def to_dict(self,as_hex=False):
-        d = self.__to_dict(self.root)
         o = {}
-        for v in d:
-            v2 = ''.join(['0123456789abcdef'[x] for x in self.__decode_key(v)[:-1]])
-            if not as_hex: v2 = v2.decode('hex')
-            o[v2] = d[v]
+        for k, v in self.iter_items():
+            o[k.encode('hex') if as_hex else k] = v
         return o
 
     def get(self,key):
-        key2 = ['0123456789abcdef'.find(x) for x in key.encode('hex')] + [16]
-        return self.__get_state(self.root,key2)
+        return self.__get_state(self.root,NibblePath.from_key(key))
+
+    def get_proof(self,key):
+        """
+        Returns a Merkle proof for the given key: the encoded nodes on the
+        lookup path from the root. It proves the key's value, or its
+        absence, to anyone who knows the root (see verify_proof).
+
+        Args:
+            key (str): The key to prove.
+
+        Returns:
+            list: The encoded nodes, root first.
+        """
+        key2 = NibblePath.from_key(key)
+        proof = []
+        node = self.root
+        while node and key2:
+            if isinstance(node,list):
+                # Embedded nodes are part of the parent already in the proof
+                curnode = node
+            else:
+                rlpnode = self.db.get(node)
+                if not rlpnode:
+                    raise Exception("node not found in database")
+                proof.append(rlpnode)
+                curnode = self.db.get_node(node)
+            if len(curnode) == 2:
+                k2 = NibblePath.from_encoded(curnode[0])
+                if not key2.startswith(k2): break
+                node, key2 = curnode[1], key2[len(k2):]
+            else:
+                node, key2 = curnode[key2[0]], key2[1:]
+        return proof
 
     def get_size(self): return self.__get_size(self.root)
 
+    def snapshot(self):
+        """
+        Opens a checkpoint that the trie can later be reverted to.
+
+        Nodes are content-addressed, so a checkpoint only keeps the root
+        (and a copy of the journal); reverting never touches the database.
+
+        Returns:
+            int: The checkpoint id, for revert or commit.
+        """
+        journal = dict(self.journal) if self.journal is not None else None
+        self.checkpoints.append((self.root,journal))
+        return len(self.checkpoints) - 1
+
+    def revert(self,checkpoint):
+        """
+        Undoes every change made since the given checkpoint, and closes it
+        together with any checkpoints opened after it.
+        """
+        if not 0 <= checkpoint < len(self.checkpoints):
+            raise Exception("unknown checkpoint")
+        self.root, self.journal = self.checkpoints[checkpoint]
+        del self.checkpoints[checkpoint:]
+
+    def commit(self,checkpoint=None):
+        """
+        With a checkpoint id, keeps the changes made since that checkpoint
+        and closes it together with any checkpoints opened after it.
+
+        Otherwise flushes the database's write overlay, if it is buffering,
+        keeping the nodes of this trie and of every other trie written to it.
+        """
+        if checkpoint is not None:
+            if not 0 <= checkpoint < len(self.checkpoints):
+                raise Exception("unknown checkpoint")
+            del self.checkpoints[checkpoint:]
+            return 0
+        return self.db.commit([self.root])
+
     def update(self,key,value):
         """
         Updates the trie with the given key-value pair.
@@ -230,5 +795,166 @@ class Trie():
         """
         if not isinstance(key,str) or not isinstance(value,str):
             raise Exception("Key and value must be strings")
-        key2 = ['0123456789abcdef'.find(x) for x in key.encode('hex')] + [16]
-        self.root = self.__update_state(self.root,key2,value)
+        self.root = self.__put_root(self.__update_state(self.root,NibblePath.from_key(key),value))
+        if self.journal is not None: self.journal[key] = value
+
+    def update_many(self,items):
+        """
+        Applies many updates in one pass, so that each node on the touched
+        paths is decoded, rewritten and hashed only once.
+
+        Args:
+            items (iterable): (key, value) pairs; an empty value deletes the
+                key, and a later pair overrides an earlier one for the same key.
+
+        Returns:
+            None
+        """
+        latest = {}
+        for key, value in items:
+            if not isinstance(key,str) or not isinstance(value,str):
+                raise Exception("Key and value must be strings")
+            latest[key] = value
+        pairs = [ (NibblePath.from_key(key),latest[key]) for key in sorted(latest) ]
+        self.root = self.__put_root(self.__apply(self.root,pairs))
+        if self.journal is not None: self.journal.update(latest)
+
+    @classmethod
+    def from_sorted_items(cls,db,items,inline_limit=0):
+        """
+        Builds a trie from a stream of (key, value) pairs sorted by key.
+
+        Nodes are assembled bottom-up on a stack of open branches, so each
+        final node is written exactly once and memory stays bounded by the
+        trie depth however long the stream is.
+
+        Args:
+            db (DB or str): The database to build the trie in.
+            items (iterable): (key, value) pairs in strictly increasing key
+                order; pairs with an empty value are skipped.
+            inline_limit (int): As for the constructor.
+
+        Returns:
+            Trie: The new trie.
+        """
+        def paths():
+            prevkey = None
+            for key, value in items:
+                if not isinstance(key,str) or not isinstance(value,str):
+                    raise Exception("Key and value must be strings")
+                if value == '': continue
+                if prevkey is not None and key <= prevkey:
+                    raise Exception("keys must be sorted and distinct")
+                prevkey = key
+                yield NibblePath.from_key(key), value
+        t = cls(db,inline_limit=inline_limit)
+        t.root = t.__put_root(t.__stream(paths()))
+        return t
+
+    @classmethod
+    def from_items_parallel(cls,db,items,processes=None,levels=2,inline_limit=0):
+        """
+        Builds a trie from many (key, value) pairs, hashing the subtrees
+        under the top branch levels in parallel across a process pool.
+
+        Workers return each subtree's encoded nodes, the top nodes are put
+        over them, and everything is stored with one write batch. The root
+        is the same as building the trie serially.
+
+        Args:
+            db (DB or str): The database to build the trie in, or None to
+                only compute the root.
+            items (iterable): (key, value) pairs in any order, with distinct
+                keys; pairs with an empty value are skipped.
+            processes (int): Number of worker processes; all cores by
+                default. With 1, or too few subtrees, no pool is started.
+            levels (int): How many branch levels to split at. Each level
+                multiplies the number of jobs by up to 16.
+            inline_limit (int): As for the constructor.
+
+        Returns:
+            Trie: The new trie, on a throwaway database if db was None.
+        """
+        keys = set()
+        triples = []
+        for key, value in items:
+            if not isinstance(key,str) or not isinstance(value,str):
+                raise Exception("Key and value must be strings")
+            if key in keys:
+                raise Exception("keys must be distinct")
+            keys.add(key)
+            if value != '': triples.append((NibblePath.from_key(key),key,value))
+        triples.sort(key=lambda t: t[1])
+        t = cls(db if db is not None else DB(storage.MemoryStore(),0),
+                inline_limit=inline_limit)
+        if not triples: return t
+        top = cls(DB(storage.MemoryStore(),0),inline_limit=inline_limit)
+        jobs = []
+        top.__split(triples,0,levels,jobs,None)
+        jobs = [ (sub,d,inline_limit,db is not None) for sub,d in jobs ]
+        if processes == 1 or len(jobs) < 2:
+            results = map(_build_subtree,jobs)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_build_subtree,jobs)
+            finally:
+                pool.terminate()
+        t.root = top.__put_root(top.__split(triples,0,levels,jobs,
+                                            iter([ ref for ref, nodes in results ])))
+        if db is not None:
+            nodes = top.db.store.data.items()
+            for ref, stored in results: nodes.extend(stored)
+            t.db.put_nodes(nodes)
+            if t.db.overlay is not None: t.db.tries.add(t)
+        return t
+
+def _build_subtree(job):
+    # Runs in a worker process: returns the subtree's reference and, if
+    # wanted, its encoded nodes
+    items, d, inline_limit, keep = job
+    store = storage.MemoryStore()
+    ref = Trie(DB(store,0),inline_limit=inline_limit)._build_subtree(items,d)
+    return ref, (store.data.items() if keep else [])
+
+def parallel_root(items,processes=None,levels=2,inline_limit=0):
+    """
+    Computes the root hash of the trie holding the given items across a
+    process pool, without storing any nodes. Useful for checking a whole
+    state against its expected root, e.g. after a restore.
+
+    Args:
+        items (iterable): (key, value) pairs, as for from_items_parallel.
+        processes (int): Number of worker processes; all cores by default.
+        levels (int): As for from_items_parallel.
+        inline_limit (int): As for Trie.
+
+    Returns:
+        str: The root hash, or '' for an empty trie.
+    """
+    return Trie.from_items_parallel(None,items,processes,levels,inline_limit).root
+
+def verify_proof(root,key,proof):
+    """
+    Checks a Merkle proof from Trie.get_proof against a trusted root,
+    without access to the trie's database.
+
+    Args:
+        root (str): The trusted root hash.
+        key (str): The key the proof is for.
+        proof (list): The encoded nodes on the lookup path.
+
+    Returns:
+        str: The value proven for key, or '' if the proof shows it is absent.
+
+    Raises:
+        Exception: If the proof does not lead from root to an answer.
+    """
+    store = storage.MemoryStore()
+    for rlpnode in proof:
+        store.put(sha256(rlpnode),rlpnode)
+    t = Trie(DB(store,0),root)
+    try:
+        return t.get(key)
+    except Exception:
+        raise Exception("invalid proof")